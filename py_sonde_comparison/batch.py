@@ -0,0 +1,200 @@
+import json
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from .logger import logger
+from .pipeline import colocate_range, pending_days, results_path, write_range_results
+from .profiling import Profiler
+
+'''
+Work queue of the colocate-batch command, to spread the colocation of a long date range over many processes and nodes.
+
+init splits the date range into work units of a number of days and records them, with the colocation parameters, in a
+SQLite database in a queue directory on a shared filesystem. Any number of work processes, on any node that sees the
+queue directory, the satellite input and the output directory, then claim units one at a time, colocate them into the
+per day shards of the output directory (see shards.py) and mark them done. merge finally assembles the shards into the
+standard results directory of each dataset over the whole date range, as colocate does.
+
+Claims are leases: a unit whose worker died is claimed again once its lease expired. Running a unit twice is harmless,
+days already in the shards are not colocated again and a day's shard is replaced atomically. SQLite relies on POSIX
+file locks, the shared filesystem has to support them (NFSv4, Lustre, GPFS do).
+'''
+
+
+class WorkQueue:
+
+    '''
+    Work units of a batch colocation in {queue}/queue.sqlite: a parameters table with the colocation parameters, and a
+    units table with one row per unit of consecutive days [start, end), its status (pending, running, done or failed),
+    the worker and time of its last claim, and the number of attempts. Every change is a short IMMEDIATE transaction,
+    so concurrent workers wait on the database lock rather than fail.
+    '''
+
+    def __init__(self, root, timeout=600.0):
+        self.root = Path(root)
+        self.path = self.root / 'queue.sqlite'
+        self.timeout = timeout
+
+    def exists(self):
+        return self.path.exists()
+
+    @contextmanager
+    def transaction(self):
+
+        # One connection per transaction, workers keep nothing open while colocating
+        with closing(sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def create(self, parameters, start_date, end_date, unit_days):
+
+        # Record the parameters and split [start_date, end_date) into units of unit_days days. Creating the queue again
+        # with the same parameters leaves it as it is, so init can be rerun safely.
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self.transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS parameters (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, start TEXT NOT NULL UNIQUE, end TEXT NOT NULL, '
+                               "status TEXT NOT NULL DEFAULT 'pending', worker TEXT, claimed REAL, finished REAL, "
+                               'attempts INTEGER NOT NULL DEFAULT 0, missing INTEGER, error TEXT)')
+            parameters = dict(parameters, start_date=f'{start_date:%Y-%m-%d}', end_date=f'{end_date:%Y-%m-%d}', unit_days=unit_days)
+            existing = {key: json.loads(value) for key,value in connection.execute('SELECT key, value FROM parameters')}
+            if existing:
+                if existing != json.loads(json.dumps(parameters)):
+                    changed = sorted(key for key in set(existing) | set(parameters) if existing.get(key) != json.loads(json.dumps(parameters.get(key))))
+                    raise ValueError(f"Queue {self.root} already holds a batch with other parameters ({', '.join(changed)})")
+                return False
+
+            connection.executemany('INSERT INTO parameters (key, value) VALUES (?, ?)', [(key,json.dumps(value)) for key,value in parameters.items()])
+            day = start_date
+            units = []
+            while day < end_date:
+                units.append((f'{day:%Y-%m-%d}',f'{min(day + timedelta(days=unit_days),end_date):%Y-%m-%d}'))
+                day += timedelta(days=unit_days)
+            connection.executemany('INSERT INTO units (start, end) VALUES (?, ?)', units)
+            return True
+
+    def parameters(self):
+        with self.transaction() as connection:
+            return {key: json.loads(value) for key,value in connection.execute('SELECT key, value FROM parameters')}
+
+    def claim(self, worker, lease):
+
+        # Claim the first pending unit, or running unit whose lease of `lease` seconds expired. Returns the unit id and
+        # its date range, or None when no unit is left to claim.
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT id, start, end FROM units WHERE status = 'pending' OR (status = 'running' AND claimed < ?) "
+                                     'ORDER BY start LIMIT 1', (now - lease,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE units SET status = 'running', worker = ?, claimed = ?, attempts = attempts + 1, error = NULL WHERE id = ?",
+                               (worker,now,row[0]))
+        return row[0], datetime.strptime(row[1],'%Y-%m-%d'), datetime.strptime(row[2],'%Y-%m-%d')
+
+    def complete(self, unit, missing):
+
+        # A unit is done whichever worker finishes it first, its days are in the shards
+        with self.transaction() as connection:
+            connection.execute("UPDATE units SET status = 'done', finished = ?, missing = ? WHERE id = ?", (time.time(),missing,unit))
+
+    def fail(self, unit, worker, error, max_attempts):
+
+        # A failed unit goes back to the queue until it failed max_attempts times. Units claimed meanwhile by another
+        # worker, after the lease expired, are left to that worker.
+        with self.transaction() as connection:
+            connection.execute("UPDATE units SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ? "
+                               "WHERE id = ? AND worker = ? AND status = 'running'", (max_attempts,error,unit,worker))
+
+    def release(self, unit, worker):
+
+        # Give an interrupted unit back to the queue, without counting the attempt
+        with self.transaction() as connection:
+            connection.execute("UPDATE units SET status = 'pending', attempts = attempts - 1 WHERE id = ? AND worker = ? AND status = 'running'",
+                               (unit,worker))
+
+    def reset(self, statuses):
+
+        # Put the units of the given statuses back in the queue, e.g. failed units once the cause is fixed
+        with self.transaction() as connection:
+            return connection.execute(f"UPDATE units SET status = 'pending', attempts = 0, error = NULL WHERE status IN ({', '.join('?' * len(statuses))})",
+                                      tuple(statuses)).rowcount
+
+    def units(self):
+        with self.transaction() as connection:
+            return connection.execute('SELECT id, start, end, status, worker, claimed, finished, attempts, missing, error FROM units ORDER BY start').fetchall()
+
+    def counts(self):
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+        with self.transaction() as connection:
+            counts.update(connection.execute('SELECT status, COUNT(*) FROM units GROUP BY status').fetchall())
+        return counts
+
+
+def batch_products(parameters):
+
+    # (dataset, input directory, ozone units) of every dataset of the batch, as colocate_range takes them
+    return tuple(tuple(product) for product in parameters['products'])
+
+def run_worker(queue, worker, lease=12 * 3600.0, max_units=None, max_attempts=3, workers=1, window=30, readahead=2, profiler=None):
+
+    # Claim and colocate units until the queue is empty, or max_units units were done. A unit that fails is given back
+    # to the queue and the worker moves on. Returns the number of units done.
+    profiler = profiler if profiler is not None else Profiler()
+    parameters = queue.parameters()
+    products = batch_products(parameters)
+    done = 0
+    while max_units is None or done < max_units:
+        claimed = queue.claim(worker,lease)
+        if claimed is None:
+            logger.info(f"{worker}: no units left in {queue.root}")
+            break
+        unit,start_date,end_date = claimed
+        logger.info(f"{worker}: colocating unit {start_date:%Y-%m-%d} to {end_date:%Y-%m-%d}")
+        try:
+            missing = colocate_range(products,start_date,end_date,parameters['output'],parameters['gaw_locations'],parameters['distance_location'],
+                                     parameters['distance_time'],parameters['sonde_prefilter'],parameters['sonde_cache'],parameters['offline'],
+                                     workers,window,readahead,profiler)
+        except (Exception, SystemExit) as e:
+            # Some failures exit rather than raise (fetch_woudc exits when WOUDC returns no features), they count as a
+            # failed attempt too, so a bad unit ends up failed instead of stopping every worker that claims it
+            error = f"exited with status {e.code}" if isinstance(e, SystemExit) else str(e)
+            logger.error(f"{worker}: unit {start_date:%Y-%m-%d} to {end_date:%Y-%m-%d} failed: {error}")
+            queue.fail(unit,worker,error,max_attempts)
+            profiler.count('units_failed')
+            continue
+        except KeyboardInterrupt:
+            queue.release(unit,worker)
+            raise
+        queue.complete(unit,sum(missing.values()))
+        profiler.count('units_done')
+        done += 1
+    return done
+
+def merge_batch(queue, profiler=None):
+
+    # Assemble the standard results directory of every dataset over the whole date range of the batch, once all units
+    # are done. Datasets whose results already exist with every day colocated are skipped.
+    counts = queue.counts()
+    if counts['done'] < sum(counts.values()):
+        raise ValueError(f"Not all units of {queue.root} are done: " + ', '.join(f'{count} {status}' for status,count in counts.items() if count))
+    parameters = queue.parameters()
+    start_date = datetime.strptime(parameters['start_date'],'%Y-%m-%d')
+    end_date = datetime.strptime(parameters['end_date'],'%Y-%m-%d')
+    products = []
+    for product in batch_products(parameters):
+        path = results_path(parameters['output'],product[0],start_date,end_date)
+        if path.exists() and not pending_days(product,start_date,end_date,parameters['output'],parameters['gaw_locations'],
+                                              parameters['distance_location'],parameters['distance_time']):
+            logger.info(f"Previous colocation results {path.name} found, skipping merge.")
+        else:
+            products.append(product)
+    write_range_results(products,start_date,end_date,parameters['output'],parameters['gaw_locations'],parameters['distance_location'],
+                        parameters['distance_time'],profiler)
@@ -0,0 +1,180 @@
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import numpy as np
+
+from .logger import logger
+from .comparison import INTERPOLATION_CACHE
+from .pipeline import colocate_soundings, convert_units
+from .products import get_product
+from .profiling import Profiler
+from .readers import Soundings, read_day
+from .results import records_to_arrays, write_results
+from .sondes import grab_woudc
+from .synthetic import SyntheticWoudcClient, write_synthetic
+
+'''
+Stage timings of the colocation pipeline on synthetic data.
+
+run_benchmark generates synthetic TROPESS Lite files and WOUDC sondes at the requested scale, then times each stage of
+colocate (read, sonde fetch/parse, match, interpolate, averaging kernel smoothing, column integration, save) by
+running the pipeline functions colocate uses with a Profiler. Each run is appended as one JSON line to the results
+file, so regressions can be tracked across commits and machines.
+
+run_startup_benchmark times fresh interpreters running the command line (--help, and colocate up to its first check)
+and records which heavy modules each of them imported.
+
+run_memory_benchmark runs colocate in fresh interpreters over a short and a long synthetic date range, with the sondes
+served from a sonde cache, and records the peak memory of each run. With a fixed --window the peak should not grow
+with the length of the date range.
+'''
+
+
+def run_benchmark(dataset='TROPESS-CRIS', start_date=datetime(2018, 1, 1), days=2, soundings_per_day=20000,
+                  sondes_per_day=20, distance_location=100.0, distance_time=3.0, seed=0, workdir=None):
+
+    # Generate synthetic data at the given scale, colocate it with the pipeline functions and return the timings and
+    # counts of each stage
+    with tempfile.TemporaryDirectory(dir=workdir) as root:
+        profiler = Profiler()
+        product = get_product(dataset)
+        INTERPOLATION_CACHE.clear()
+
+        with profiler.stage('generate'):
+            features = write_synthetic(root, dataset, start_date, days, soundings_per_day, sondes_per_day, seed)
+
+        with profiler.stage('read'):
+            soundings = convert_units(Soundings.concatenate([read_day(root, product, start_date + timedelta(days=j))
+                                                             for j in range(days)]), product.ozone_units)
+
+        client = SyntheticWoudcClient(features)
+        with profiler.stage('sonde_fetch_parse'):
+            sondes = grab_woudc(start_date, start_date + timedelta(days=days), 'all', client=client)
+
+        # match, interpolate, smooth and column stages
+        records = colocate_soundings(soundings, sondes, np.arange(len(sondes)), distance_location, distance_time, profiler)
+
+        with profiler.stage('save'):
+            write_results(Path(root) / 'benchmark_colocation', records_to_arrays(records))
+
+    return {'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'parameters': {'dataset': dataset, 'start_date': start_date.strftime('%Y-%m-%d'), 'days': days,
+                           'soundings_per_day': soundings_per_day, 'sondes_per_day': sondes_per_day,
+                           'distance_location': distance_location, 'distance_time': distance_time, 'seed': seed},
+            'stages': {name: round(stage['seconds'], 6) for name, stage in profiler.stages.items()},
+            'counts': {'soundings': len(soundings), 'sondes': len(sondes),
+                       'pairs': profiler.counts.get('candidate_pairs', 0), 'accepted': len(records)}}
+
+
+def record_benchmark(result, output):
+
+    # Append one benchmark result to a JSON lines file
+    with open(output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    for name, seconds in result['stages'].items():
+        logger.info(f"Benchmark stage {name}: {seconds:.3f} s")
+
+
+# Modules that are slow to import, and should only be loaded by the commands that need them
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'xarray', 'matplotlib', 'seaborn', 'pywoudc']
+
+# Run in a fresh interpreter: invoke the command line with the given arguments, then report the heavy modules loaded
+STARTUP_SCRIPT = """
+import contextlib, io, json, sys
+from py_sonde_comparison.cli import cli
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        cli.main(sys.argv[1:], prog_name='py-sonde-comparison', standalone_mode=False)
+    except SystemExit:
+        pass
+print(json.dumps(sorted(name for name in %r if name in sys.modules)))
+""" % HEAVY_MODULES
+
+
+def startup_commands(workdir):
+
+    # Command lines timed by run_startup_benchmark. colocate runs offline without a sonde cache, so it stops at its
+    # first check, after importing everything the command itself needs.
+    return {'help': ['--help'],
+            'colocate_help': ['colocate', '--help'],
+            'plot_results_help': ['plot-results', '--help'],
+            'colocate': ['colocate', '-ds', 'TROPESS-CRIS', '-sd', '2018-01-01', '-ed', '2018-01-02', '-i', workdir,
+                         '-o', workdir, '-ou', 'None', '-gl', 'all', '-dl', '100', '-dt', '3', '--offline']}
+
+
+def run_startup_benchmark(repeats=5, workdir=None):
+
+    # Best of repeats wall time (seconds) of each startup command in a new interpreter, and the heavy modules it loaded
+    with tempfile.TemporaryDirectory(dir=workdir) as root:
+        stages, loaded = {}, {}
+        for name, arguments in startup_commands(root).items():
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT] + arguments, capture_output=True, text=True, check=True)
+                times.append(time.perf_counter() - start)
+            stages[name] = round(min(times), 6)
+            loaded[name] = json.loads(process.stdout.strip().splitlines()[-1])
+
+    return {'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'parameters': {'benchmark': 'startup', 'repeats': repeats},
+            'stages': stages,
+            'loaded_modules': loaded}
+
+
+# Run in a fresh interpreter: invoke the command line with the given arguments, then report the peak memory
+MEMORY_SCRIPT = """
+import json, sys
+from py_sonde_comparison.cli import cli
+from py_sonde_comparison.profiling import peak_rss_mb
+try:
+    cli.main(sys.argv[1:], prog_name='py-sonde-comparison', standalone_mode=False)
+except SystemExit as e:
+    if e.code:
+        raise
+print(json.dumps({'peak_rss_mb': peak_rss_mb()}))
+"""
+
+
+def run_memory_benchmark(dataset='TROPESS-CRIS', start_date=datetime(2018, 1, 1), short_days=15, long_days=60,
+                         window=5, soundings_per_day=1000, sondes_per_day=100, seed=0, workdir=None):
+
+    # Peak RSS (MB) and wall time of colocate over short_days and long_days of synthetic data with the given window,
+    # each in a new interpreter. growth is the ratio of the long to the short run's peak RSS.
+    with tempfile.TemporaryDirectory(dir=workdir) as root:
+        root = Path(root)
+        features = write_synthetic(root / 'input', dataset, start_date, long_days, soundings_per_day, sondes_per_day, seed)
+        grab_woudc(start_date, start_date + timedelta(days=long_days), 'all', root / 'sondes', client=SyntheticWoudcClient(features))
+        del features
+
+        stages, peak_rss = {}, {}
+        for days in (short_days, long_days):
+            output = root / f'output_{days}'
+            output.mkdir()
+            arguments = ['colocate', '-ds', dataset, '-sd', start_date.strftime('%Y-%m-%d'),
+                         '-ed', (start_date + timedelta(days=days)).strftime('%Y-%m-%d'), '-i', str(root / 'input'),
+                         '-o', str(output), '-gl', 'all', '-dl', '100', '-dt', '3', '--offline',
+                         '--sonde-cache', str(root / 'sondes'), '--window', str(window)]
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, '-c', MEMORY_SCRIPT] + arguments, capture_output=True, text=True, check=True)
+            stages[f'colocate_{days}_days'] = round(time.perf_counter() - start, 6)
+            peak_rss[str(days)] = round(json.loads(process.stdout.strip().splitlines()[-1])['peak_rss_mb'], 1)
+
+    return {'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'parameters': {'benchmark': 'memory', 'dataset': dataset, 'start_date': start_date.strftime('%Y-%m-%d'),
+                           'short_days': short_days, 'long_days': long_days, 'window': window,
+                           'soundings_per_day': soundings_per_day, 'sondes_per_day': sondes_per_day, 'seed': seed},
+            'stages': stages,
+            'peak_rss_mb': peak_rss,
+            'growth': round(peak_rss[str(long_days)] / peak_rss[str(short_days)], 3)}
@@ -1,19 +1,16 @@
-from pywoudc import WoudcClient
-from datetime import datetime, timedelta
-from matplotlib.pyplot import *
-import math
+from datetime import datetime
 from pathlib import Path
-import xarray as xr
-import numpy as np
-from scipy import interpolate
 import os,sys,fnmatch
-import seaborn as sns
 import warnings
 import click
 warnings.filterwarnings("error", category=RuntimeWarning)
-sns.set_theme(style="darkgrid")
 
 from .logger import logger
+from .products import get_product, product_names
+from .profiling import Profiler, peak_rss_mb
+
+# Heavy dependencies (numpy, xarray, scipy, pandas, matplotlib, seaborn) are only imported inside the commands that
+# use them, so --help and the colocate command do not load the plotting stack.
 
 # Note when running in environment, need to install pip install xarray[complete], need to find out why
 
@@ -40,374 +37,224 @@ WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWIS
 
 '''
 
-def grab_woudc(start_date,end_date,gaw_locations): 
-    # Function based on pywoudc information, grabs ozonesonde profiles
-    # based on the supplied daterange
+@click.group()
+def cli():
+    pass
 
-    # Invoke pyWoudc 
-    client = WoudcClient()
 
-    # Set date range for ozonesonde comparison
-    begin = start_date
-    end = end_date
-    
-    
-    # Grab ozonesonde data, either all available data, or from a specific site
-    if gaw_locations=='all':
-        data = client.get_data('ozonesonde',
-                                temporal=[begin, end])
-    else:
-        data = client.get_data('ozonesonde',
-                            filters={'gaw_id': gaw_locations},
-                            temporal=[begin, end])
-        
-    # Routine to check if any sonde data has been found by input specifications, if not
-    # program exits.
-    try:
-        logger.info(f"Number of Sondes in date range {len(data['features'])}")
-    except Exception as e:
-        logger.error(f"No Sonde data available, or incorrect sonde site input, exiting.....{e}")   
+def colocation_options(function):
+
+    # Options shared by colocate and colocate-batch init, which colocate the same way
+    options = [
+        click.option('--dataset', '-ds', required=True, multiple=True, type=click.Choice(product_names(), case_sensitive=False),help='Indicate the source of the data in use, one of the products registered in products.py. Can be given several times to colocate several datasets in one pass, sharing the sondes.'),
+        click.option("--start-date", "-sd", required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help="yyyy-mm-dd string that represents the start date of the analysis."),
+        click.option("--end-date", "-ed", required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help="yyyy-mm-dd string that represents the end date of the analysis."),
+        click.option("--input", "-i", required=True, multiple=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="input directory. L2 satellite ozone data is stored here, following the dataset's file pattern. Given once for every dataset (in the same order), or once for all of them."),
+        click.option("--output", "-o", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="output directory. Colocation results, and the per day shards they are assembled from, will be saved here."),
+        click.option('--ozone-units', '-ou', default=None, type=click.Choice(['None', 'ppb', 'ppm'], case_sensitive=False),help="Indicate what units are used in the data product, by default the units declared for the dataset"),
+        click.option('--gaw-locations', '-gl', required=True, type=str,help="Indicate whether to make comparisons with all sonde locations ('all'), a comma separated list of GAW IDs, or the stations listed in a station file (one GAW ID per line)"),
+        click.option('--distance-location', '-dl', required=True, type=float,help="Indicate perfered distance colocation criteria between satellite sounding and ozonesonde"),
+        click.option('--distance-time', '-dt', required=True, type=float,help="Indicate perfered maximum period in time for colocation between satellite sounding and ozonesonde"),
+        click.option('--sonde-prefilter', '-sp', is_flag=True, default=False, help="Fetch the sondes first, and only read satellite soundings that fall within the colocation criteria of a sonde."),
+        click.option('--sonde-cache', '-sc', default=None, type=click.Path(file_okay=False, dir_okay=True), help="Directory of the local ozonesonde cache, only days not yet cached are requested from WOUDC."),
+        click.option('--offline', is_flag=True, default=False, help="Only use ozonesondes from the local sonde cache, WOUDC is not contacted."),
+    ]
+    for option in reversed(options):
+        function = option(function)
+    return function
+
+
+def colocation_products(dataset,input,ozone_units,sonde_cache,offline):
+
+    # Every dataset is read from its own input directory, with its own units unless --ozone-units is given. Returns
+    # (dataset, input directory, ozone units) of each dataset, in order and without repeats.
+    datasets = list(dict.fromkeys(dataset))
+    if len(input) not in (1,len(datasets)):
+        logger.error(f"{len(input)} input directories given for {len(datasets)} datasets, give one per dataset or a single one")
         sys.exit(1)
-    
-    return data
-    
-def distance(lat1, long1, lat2, long2):
-    
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    """
-    # convert decimal degrees to radians
-    try:
-        lat1, long1, lat2, long2 = map(math.radians, [lat1, long1, lat2, long2])
-        # haversine formula 
-        dlon = long2 - long1 
-        dlat = lat2 - lat1 
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a)) 
-        # Radius of earth in kilometers is 6371
-        km = 6371* c
-    except Exception as e:
-        logger.error(f"Error in calculating colocation distance {e}")   
+    if offline and sonde_cache is None:
+        logger.error("Offline mode requires a --sonde-cache directory")
         sys.exit(1)
-    return km
+    inputs = input if len(input) == len(datasets) else input * len(datasets)
+    return [(i,inputs[n],ozone_units or get_product(i).ozone_units) for n,i in enumerate(datasets)]
 
-def convert_sensitivity(AK,apriori,model,AK_Log=True):
-    
-    # Short script to account for sensitivity between model and retrieval,
-    # H(·) = xa + A(M(·) − xa), as Equation 7 in https://doi.org/10.5194/egusphere-2022-774
-    
-    # If Averaging Kernel is provided as log, currently assume this to be the case as standard.
-    # Author notes, will likely need this section to be more flexible.
+
+@cli.command(help="Colocate ozonesondes with provided satellite input")
+@colocation_options
+@click.option('--workers', '-w', default=1, show_default=True, type=click.IntRange(min=1), help="Number of worker processes, each day of the date range is colocated as a separate task.")
+@click.option('--window', '-wd', default=30, show_default=True, type=click.IntRange(min=0), help="Number of days colocated at a time, the sondes of a window are fetched and its days colocated and saved before the next window, so memory depends on the window rather than the date range. 0 colocates the whole date range at once.")
+@click.option('--readahead', '-ra', default=2, show_default=True, type=click.IntRange(min=0), help="Number of upcoming days whose satellite files are read in background threads while a day is colocated, 0 reads each day when it is colocated. Without --workers only.")
+@click.option('--profile', '-p', default=None, type=click.Path(dir_okay=False), help="Write per stage wall time, peak memory and counts to this report file, as CSV if it ends in .csv, otherwise JSON.")
+def colocate(dataset,start_date,end_date,input,output,ozone_units,gaw_locations,distance_location,distance_time,sonde_prefilter,sonde_cache,offline,workers,window,readahead,profile):
     try:
-        if AK_Log == True:
-            modified_profile = np.exp(np.log(apriori) + (AK@(np.log(model) - np.log(apriori))))
-        elif AK_Log == False:
-            modified_profile = apriori + (AK@(model - apriori))
-        else:
-            logger.error(f"Currently only True or False is accepted")   
-            sys.exit(1)
-    except RuntimeWarning as e:
-        logger.warning(f"Warning in sensitivity modification :{e}")
-        if AK_Log == True:
-            modified_profile = np.exp(np.log(apriori) + (AK@(np.log(model) - np.log(apriori))))
-        elif AK_Log == False:
-            modified_profile = apriori + (AK@(model - apriori))
-        else:
-            logger.error(f"Currently only True or False is accepted")   
-            sys.exit(1)
-          
-    except Exception as e:
-        logger.error(f"Error in sensitivity modification :{e}")   
-        sys.exit(1)
+        from .pipeline import colocate_range, pending_days, results_path, write_range_results
+        from .sondes import station_list
 
-    
-    return modified_profile
+        products = colocation_products(dataset,input,ozone_units,sonde_cache,offline)
+        gaw_locations = station_list(gaw_locations)
 
-def convert_ppm_to_du(pressure,vmr):
-    
-    # This subroutine converts a profile of ozone values in ppm
-    # into a single column value expressed as DU. Works between any particular pressure range.
+        profiler = Profiler()
 
-    try:
-        outO3 = []
-        pressure_mid_total = []
-        # First calculate mid points
-        for i in range(len(pressure)-1):
-            pressure_mid = (pressure[i+1] + pressure[i])/2
-            pressure_mid_total.append(pressure_mid)
-
-        # Then Calculate O3 VMRs at midpoint
-        o3_mid = np.interp(np.flip(np.asarray(pressure_mid_total)),np.flip(pressure),np.flip(vmr))
-        # Then calculate O3 DUs
-        o3_mid = np.flip(o3_mid)
-        for j in range(len(pressure)-1):
-            o3DU = (float((o3_mid[j])/1000)*1e-6) * (((float(pressure[j])-float(pressure[j+1]))/9.8)*100*(1e-4)*(1/(28.96e-3))*(6.022e23)*(1/(2.6867e16)))
-            outO3.append(o3DU)
-    except Exception as e:
-        logger.error(f"Error in calculating ozone column value: {e}")   
-        sys.exit(1)
+        # The following subroutine colocates ozonesonde data with satellite retrievals, based on the input data.
+        # All colocated data is output as a results directory of typed .npy files (see results.py) per dataset, which
+        # can then be read by other routines to plot data and be manipulated as desired.
+
+        # Initially check if code has been run before, and skip the datasets whose results already exist with every
+        # day colocated. Results with days still pending are colocated and written again.
+        remaining = []
+        for product in products:
+            path = results_path(output,product[0],start_date,end_date)
+            if os.path.exists(path):
+                # Co-location routine checks to see if comparisons already exist.
+                pending = pending_days(product,start_date,end_date,output,gaw_locations,distance_location,distance_time)
+                if not pending:
+                    logger.info(f"Previous colocation results {path.name} found, skipping colocation.")
+                    continue
+                logger.info(f"Previous colocation results {path.name} found with {len(pending)} days not colocated yet, colocating them.")
+            remaining.append(product)
+        products = tuple(remaining)
 
-    return np.sum(outO3)
+        if products:
+            missing = colocate_range(products,start_date,end_date,output,gaw_locations,distance_location,distance_time,sonde_prefilter,
+                                     sonde_cache,offline,workers,window,readahead,profiler)
+            write_range_results(products,start_date,end_date,output,gaw_locations,distance_location,distance_time,profiler,missing)
 
-def read_product(path,dataset,start_date,end_date):
-        
-    # Read provided satellite data product, in order to provide standard data formats to the rest of the program.
-    # May have to be modified to account for different products, current accepted products:
-    # TROPESS
+        if profile is not None:
+            profiler.write(profile,'colocate')
 
-    try:
-        # Reading data from TROPESS products
-        if dataset.lower() == 'tropess-cris' or dataset.lower() == 'tropess-airsomi':
-            # Start lists for storing data
-            quality = []
-            date = []
-            hour = []
-            latitude = []
-            longitude = []
-            ozone = []
-            ozone_apriori = []
-            aver_ker = []
-            pressure = []
-
-            time_period = end_date - start_date
-                
-            for j in range(0,time_period.days):
-                #self.date.append(dates[j])
-                dates = start_date + timedelta(days=j)
-                if dataset.lower() == 'tropess-cris':
-                    path_to_target = Path(f'/tb/CrIS/results/CRIS/Release_1.17.0/Global_Survey_Grid_0.8_RS/Products/{dates.year:02}/{dates.month:02}/{dates.day:02}/batch-01/L2_Products_Lite/CRIS_L2-O3-0_{dates.year:02}_{dates.month:02}_{dates.day:02}_F01_1.17_Litev01_Day_Night.nc').expanduser()
-                elif dataset.lower() == 'tropess-airsomi':
-                    path_to_target = Path(f'/tb/AIRSOMI/Release_1.17.0/Global_Survey_Grid_0.7/Products/{dates.year:02}/{dates.month:02}/{dates.day:02}/L2_Products_Lite/AIRS_OMI_ATrain_L2-O3_{dates.year:02}_{dates.month:02}_{dates.day:02}_F01_1.17_Litev01.nc').expanduser()
-                
-                    
-                try:
-                    # Use XArray to open and store dataset
-                    general = (xr.open_dataset(path_to_target.as_posix(),engine="h5netcdf"))
-                except Exception as e:
-                    logger.info(f"{dates.year:02}_{dates.month:02}_{dates.day:02} Not available, skipping....")
-                    continue
-                        
-                # Capturing TROPESS data, according the format of the data product.
-                quality     = np.where((general.Quality.values > 0))[0]
-                for l,k in enumerate(quality):
-                    indpp = np.where(general.Pressure.values[k] > -999.0)[0]
-                    date.append(datetime.strptime(str(int(general.YYYYMMDD.values[k])),'%Y%m%d').date())
-                    latitude.append(general.Latitude.values[k])
-                    longitude.append(general.Longitude.values[k])
-                    ozone.append(general.Species.values[k,indpp])
-                    ozone_apriori.append(general.ConstraintVector.values[k,indpp])
-                    aver_ker.append(general.AveragingKernel.values[k,26-len(indpp):,26-len(indpp):])
-                    pressure.append(general.Pressure.values[k,indpp])
-                    hour.append(general.UT_Hour[k])
-        
+        sys.exit(0)
     except Exception as e:
         logger.error(f"Failed: {e}")
         sys.exit(1)
         
-    return date,latitude,longitude,ozone,ozone_apriori,aver_ker,pressure,hour
-    
+        
 
-@click.group()
-def cli():
+@cli.group(name="colocate-batch",help="Colocate a long date range with any number of worker processes, on any nodes sharing a queue directory, the input and the output directory: init splits the date range into work units, work colocates units until none is left, merge writes the standard results.")
+def colocate_batch():
     pass
 
+@colocate_batch.command(name="init",help="Create a batch queue, splitting the date range into work units")
+@click.option("--queue", "-q", required=True, type=click.Path(file_okay=False, dir_okay=True), help="Queue directory on a filesystem shared by all workers, created if needed.")
+@colocation_options
+@click.option('--unit-days', '-ud', default=30, show_default=True, type=click.IntRange(min=1), help="Number of days of a work unit.")
+def colocate_batch_init(queue,dataset,start_date,end_date,input,output,ozone_units,gaw_locations,distance_location,distance_time,sonde_prefilter,sonde_cache,offline,unit_days):
+    try:
+        from .batch import WorkQueue
+        from .sondes import station_list
 
-@cli.command(help="Colocate ozonesondes with provided satellite input")
-@click.option('--dataset', '-ds', required=True, type=click.Choice(['TROPESS-CRIS'], case_sensitive=False),help='Indicate the source of the data in use.')
-@click.option("--start-date", "-sd", required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help="yyyy-mm-dd string that represents the start date of the analysis.")
-@click.option("--end-date", "-ed", required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help="yyyy-mm-dd string that represents the end date of the analysis.")
-@click.option("--input", "-i", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="input directory. L2 satellite ozone data is stored here.")
-@click.option("--output", "-o", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="output directory. npz files will be saved here. ")
-@click.option('--ozone-units', '-ou', required=True, type=click.Choice(['None', 'ppb', 'ppm'], case_sensitive=False),help="Indicate what units are used in the data product")
-@click.option('--gaw-locations', '-gl', required=True, type=click.Choice(['all'], case_sensitive=False),help="Indicate whether to make comparisons with all sonde locations, or a specific site")
-@click.option('--distance-location', '-dl', required=True, type=float,help="Indicate perfered distance colocation criteria between satellite sounding and ozonesonde")
-@click.option('--distance-time', '-dt', required=True, type=float,help="Indicate perfered maximum period in time for colocation between satellite sounding and ozonesonde")
-def colocate(dataset,start_date,end_date,input,output,ozone_units,gaw_locations,distance_location,distance_time):
-    try:   
-        # The following subroutine colocates ozonesonde data with satellite retrievals, based on the input data.
-        # All colocated data is output in the form of .npz files, which can then be read by other routines to plot data
-        # and be manipulated as desired. 
+        products = colocation_products(dataset,input,ozone_units,sonde_cache,offline)
 
-        dates,latitudes,longitudes,ozone_profiles,ozone_aprioris,aver_kers,pressure,hours = read_product(input,dataset,start_date,end_date)
+        # Directories are recorded as absolute paths, workers may run from anywhere
+        parameters = {'products': [(i,os.path.abspath(path),units) for i,path,units in products],
+                      'output': os.path.abspath(output), 'gaw_locations': station_list(gaw_locations),
+                      'distance_location': distance_location, 'distance_time': distance_time, 'sonde_prefilter': sonde_prefilter,
+                      'sonde_cache': os.path.abspath(sonde_cache) if sonde_cache is not None else None, 'offline': offline}
 
-        
-        latitudes = np.asarray(latitudes,dtype=object)
-        longitudes = np.asarray(longitudes,dtype=object)
-        
-        # We currently do not know what units ozone will be 
-        if ozone_units == str(None):
-            logger.info("Satellite ozone profile units not selected, converting to ppb")
-            ozone_profiles = np.asarray(ozone_profiles,dtype=object)*1e9
-            ozone_aprioris = np.asarray(ozone_aprioris,dtype=object)*1e9
-        elif ozone_units == 'ppb':
-            ozone_profiles = np.asarray(ozone_profiles,dtype=object)
-            ozone_aprioris = np.asarray(ozone_aprioris,dtype=object)
-        elif ozone_units == 'ppm':
-            ozone_profiles = np.asarray(ozone_profiles,dtype=object)*1000
-            ozone_aprioris = np.asarray(ozone_aprioris,dtype=object)*1000
+        work_queue = WorkQueue(queue)
+        if work_queue.create(parameters,start_date,end_date,unit_days):
+            logger.info(f"Created queue {work_queue.path} with {sum(work_queue.counts().values())} units")
         else:
-            print("Unit choice not supported,'None', 'ppb', or 'ppm' are currently supported.")
-            logger.error("Unit choice not supported,'None', 'ppb', or 'ppm' are currently supported.")
+            logger.info(f"Queue {work_queue.path} already exists with the same parameters, keeping it")
+        sys.exit(0)
+    except Exception as e:
+        logger.error(f"Failed: {e}")
+        sys.exit(1)
+
+@colocate_batch.command(name="work",help="Claim and colocate units of a batch queue until none is left, run as many as wanted on any nodes")
+@click.option("--queue", "-q", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="Queue directory created by colocate-batch init.")
+@click.option('--worker-id', default=None, type=str, help="Name of this worker in the queue, by default host name and process ID.")
+@click.option('--lease', default=12.0, show_default=True, type=click.FloatRange(min=0, min_open=True), help="Hours after which a unit claimed by a worker that has not finished it may be claimed by another worker, should exceed the run time of a unit.")
+@click.option('--max-units', default=None, type=click.IntRange(min=1), help="Stop after this many units, by default work until the queue is empty.")
+@click.option('--max-attempts', default=3, show_default=True, type=click.IntRange(min=1), help="Number of times a unit is tried before it is marked failed.")
+@click.option('--workers', '-w', default=1, show_default=True, type=click.IntRange(min=1), help="Number of worker processes colocating the days of a unit.")
+@click.option('--window', '-wd', default=30, show_default=True, type=click.IntRange(min=0), help="Number of days of a unit colocated at a time, see colocate --window.")
+@click.option('--readahead', '-ra', default=2, show_default=True, type=click.IntRange(min=0), help="Number of upcoming days whose satellite files are read in background threads while a day is colocated. Without --workers only.")
+@click.option('--profile', '-p', default=None, type=click.Path(dir_okay=False), help="Write per stage wall time, peak memory and counts to this report file, as CSV if it ends in .csv, otherwise JSON.")
+def colocate_batch_work(queue,worker_id,lease,max_units,max_attempts,workers,window,readahead,profile):
+    try:
+        import socket
+        from .batch import WorkQueue, run_worker
+
+        work_queue = WorkQueue(queue)
+        if not work_queue.exists():
+            logger.error(f"No queue in {queue}, create it with colocate-batch init")
             sys.exit(1)
-            
-        pressure = np.asarray(pressure,dtype=object)
-        averaging_kernel = aver_kers
-
-        # Grabs the relevant sonde data
-        sonde_data = grab_woudc(start_date,end_date,gaw_locations)
-        # Common pressure grid to interpolate to, based on CAMS grid
-        pressure_grid = np.asarray([10.0,20.0,30.0,50.0,70.0,100.0,150.0,200.0,250.0,300.0,400.0,500.0,600.0,700.0,800.0,850.0,900.0,925.0,950.0,1000.0],dtype=float)
-        
-        # Initialising lists to save data, assuming will add to this in the future.
-        difference_profile_percent = []
-        difference_profile_absolute = []
-        difference_troposphere_percent = []
-        difference_troposphere_absolute = []     
-        latitude_colocation = []
-        time_vector = []
-        
-        # Initially check if code has been run before, and load datafile if it already exists. compare sonde date with satellite data date
-        if not os.path.exists(Path(f'{output}/{dataset}_sonde_colocation_{start_date.year}_{start_date.month}_{start_date.day}_{end_date.year}_{end_date.month}_{end_date.day}.npz')): 
-                    
-            for i in range(0,len(sonde_data['features'])):
-                ozone_date = datetime.strptime(sonde_data['features'][i]['properties']['instance_datetime'], '%Y/%m/%d %H:%M:%S+00') 
-                for j in range(0,len(latitudes)):
-                    
-                    # Check if dates match with satellite data days
-                    if ozone_date.year == dates[j].year and ozone_date.month == dates[j].month and ozone_date.day == dates[j].day:
-                        # Check if time difference is less than 3 hours
-                        if np.absolute(float(ozone_date.hour) - float(hours[j])) < distance_time:
-                            # Check if satellite retrieval is within the specified distance
-                            if distance(latitudes[j], longitudes[j], sonde_data['features'][i]['geometry']['coordinates'][1], sonde_data['features'][i]['geometry']['coordinates'][0]) <= distance_location:
-                                logger.info(f"Match, Lat/long {latitudes[j]}, {longitudes[j]}, {sonde_data['features'][i]['geometry']['coordinates'][1]}, {sonde_data['features'][i]['geometry']['coordinates'][0]}, {ozone_date.year}, {ozone_date.month}, {ozone_date.day}")
-                                # Grab data, convert to satellite retrieval grid and account for sensitivity
-                                captured_data = sonde_data['features'][i]['properties']['data_block'].split('\r\n')
-                                sonde_vmr_mid = []
-                                sonde_pressure_mid = []
-
-                                # Some sonde locations have different data formats
-                                if captured_data[0].split(",")[0] == 'Duration':
-                                    startPoint = 1
-                                else:
-                                    startPoint = 0
-
-                                # Flag to check if too many values are missing in the ozonesonde dataset
-                                errorBreak = 0
-                                for iCapture in range(1,len(captured_data)-1): 
-
-                                    # Grab all pressure and ozone values from sonde data, and check if all values are available.
-                                    # empty strings are checked for with 'float', if missing are skipped.
-                                    try:
-                                        sonde_vmr_mid.append(float(captured_data[iCapture].split(",")[startPoint+1]))
-                                        sonde_pressure_mid.append(float(captured_data[iCapture].split(",")[startPoint]))
-                                    except ValueError:
-                                        errorBreak+=1
-                                        if errorBreak == 5:
-                                            logger.info("Ozonesonde missing too many values, skipping....")
-                                            break
-
-                                        continue
-
-                                # select valid sonde levels and check pressure is correct way around
-                                if sonde_pressure_mid[0] > sonde_pressure_mid[1]:
-                                    sonde_pressure_mid = np.flip(np.asarray(sonde_pressure_mid,dtype=float))
-                                    indpp_2 = np.where(sonde_pressure_mid > 0)[0] 
-                                    sonde_vmr_partial = np.flip(np.asarray(sonde_vmr_mid,dtype=float))[indpp_2]
-                                else:
-                                    sonde_pressure_mid = np.asarray(sonde_pressure_mid,dtype=float)
-                                    indpp_2 = np.where(np.asarray(sonde_pressure_mid,dtype=float) > 0)[0] 
-                                    sonde_vmr_partial = np.asarray(sonde_vmr_mid,dtype=float)[indpp_2]
-
-                                sonde_vmr = (sonde_vmr_partial/(sonde_pressure_mid[indpp_2]*100000))*1e9
-
-                                # Interpolate sonde to satellite retrieval pressure grid
-
-                                # Check that the satellite pressure is surface first
-                                if pressure[j][0] > pressure[j][1]:
-                                    sat_pressure = np.flip(pressure[j][:])
-                                    sat_ozone_profile = np.flip(ozone_profiles[j][:])
-                                    sat_ozone_profile_prior = np.flip(ozone_aprioris[j][:])
-                                    sat_averaging_kernel = np.flipud(np.fliplr(averaging_kernel[j][:][:]))
-                                else:
-                                    sat_pressure = pressure[j][:]
-                                    sat_ozone_profile = ozone_profiles[j][:]
-                                    sat_ozone_profile_prior = ozone_aprioris[j][:]
-                                    sat_averaging_kernel = averaging_kernel[j][:][:]
-
-
-                                # Interpolate sondes and satellites to common grid
-                                # Try except to catch and remove strange behaviour
-                                try:
-                                    interp_model_sonde = interpolate.interp1d(np.asarray(sonde_pressure_mid)[indpp_2], sonde_vmr,fill_value="extrapolate")
-                                    sonde_profile_mod = interp_model_sonde(pressure_grid)
-
-                                    interp_model_satellite = interpolate.interp1d(sat_pressure,sat_ozone_profile,fill_value="extrapolate")
-                                    satellite_profile_mod = interp_model_satellite(pressure_grid)
-                                    interp_model_satellite_prior = interpolate.interp1d(sat_pressure, sat_ozone_profile_prior,fill_value="extrapolate")
-                                    satellite_profile_apriori_mod = interp_model_satellite_prior(pressure_grid)
-                                    interp_model_satellite_ak = interpolate.interp2d(sat_pressure,sat_pressure, sat_averaging_kernel)
-                                    satellite_profile_ak_mod = interp_model_satellite_ak(pressure_grid,pressure_grid)
-                                    # Modify Sondes to sensitivity of instrument
-                                    sond_profile_ak = convert_sensitivity(satellite_profile_ak_mod,satellite_profile_apriori_mod,sonde_profile_mod)
-
-                                    # Store differences and ignore large differences                          
-                                    if np.absolute(100 * ((satellite_profile_mod - sond_profile_ak) / sond_profile_ak))[-1] < 200:
-                                        difference_profile_percent.append(100 * ((satellite_profile_mod - sond_profile_ak) / sond_profile_ak))
-                                        difference_profile_absolute.append((satellite_profile_mod - sond_profile_ak)* 1e9)
-
-                                        # Setting Troposphere requirements as to HEGIFTOM:
-                                        # From ground to 150 hPa in the tropics (within 15° )
-                                        # From ground to 200 hPa in the subtropics (15°-30°)
-                                        # From ground to 300 hPa in the midlatitudes (30°-60°)
-                                        # From ground to 400 hPa in the polar regions (> 60°)
-                                        if latitudes[j] > -15.0 and latitudes[j] < 15.0:
-                                            end = 11
-                                        elif latitudes[j] > -30.0 and latitudes[j] <= -15.0 or latitudes[j] < 30.0 and latitudes[j] >= 15.0:
-                                            end = 12
-                                        elif latitudes[j] > -60.0 and latitudes[j] <= -30.0 or latitudes[j] < 60.0 and latitudes[j] >= 30.0:
-                                            end = 14
-                                        elif latitudes[j] < -60.0 and latitudes[j] > 60.0:
-                                            end = 15
-
-
-                                        difference_troposphere_percent.append(100 * convert_ppm_to_du(pressure_grid[end:],((satellite_profile_mod[end:] - sond_profile_ak[end:]) / sond_profile_ak[end:])))
-                                        difference_troposphere_absolute.append(convert_ppm_to_du(pressure_grid[end:],(satellite_profile_mod[end:] - sond_profile_ak[end:])* 1e6))
-                                        latitude_colocation.append(latitudes[j])
-                                        time_vector.append(ozone_date)
-
-                                    else:
-                                        logger.info("Warning sonde/satellite difference over 200%, skipping....")
-                                        continue
-                                except RuntimeWarning as e:
-                                    logger.info(f"Runtime error {e}")
-                                    continue
-
-                        else:
-                            continue
-        
+        worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
 
-            with open(Path(f'{output}/{dataset}_sonde_colocation_{start_date.year}_{start_date.month}_{start_date.day}_{end_date.year}_{end_date.month}_{end_date.day}.npz'), 'wb') as f:
-                np.savez(f,difference_profile_percent=difference_profile_percent,difference_profile_absolute=difference_profile_absolute, difference_troposphere_percent=difference_troposphere_percent,difference_troposphere_absolute=difference_troposphere_absolute,latitude_colocation=latitude_colocation,time_vector=time_vector)
-                f.close()
+        profiler = Profiler()
+        done = run_worker(work_queue,worker_id,lease * 3600.0,max_units,max_attempts,workers,window,readahead,profiler)
+        logger.info(f"{worker_id}: {done} units done")
 
-        else:
-            # Co-location routine checks to see if comparisons already exist.
-            logger.info(f"Previous colocation file {dataset}_sonde_colocation_{start_date.year}_{start_date.month}_{start_date.day}_{end_date.year}_{end_date.month}_{end_date.day}.npz found, skipping colocation.")
-         
+        if profile is not None:
+            profiler.write(profile,'colocate-batch work')
+        sys.exit(0)
+    except Exception as e:
+        logger.error(f"Failed: {e}")
+        sys.exit(1)
 
+@colocate_batch.command(name="status",help="Show the progress of a batch queue")
+@click.option("--queue", "-q", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="Queue directory created by colocate-batch init.")
+@click.option('--units', '-u', is_flag=True, default=False, help="List every unit, with its worker, attempts and last error.")
+@click.option('--retry-failed', is_flag=True, default=False, help="Put the failed units back in the queue.")
+def colocate_batch_status(queue,units,retry_failed):
+    try:
+        from .batch import WorkQueue
+
+        work_queue = WorkQueue(queue)
+        if not work_queue.exists():
+            logger.error(f"No queue in {queue}, create it with colocate-batch init")
+            sys.exit(1)
+        if retry_failed:
+            logger.info(f"{work_queue.reset(['failed'])} failed units put back in the queue")
+
+        if units:
+            for _,start,end,status,worker,claimed,finished,attempts,missing,error in work_queue.units():
+                line = f"{start} to {end}: {status}, {attempts} attempts"
+                if worker is not None:
+                    line += f", last claimed by {worker} at {datetime.fromtimestamp(claimed):%Y-%m-%d %H:%M:%S}"
+                if finished is not None and status == 'done':
+                    line += f", done at {datetime.fromtimestamp(finished):%Y-%m-%d %H:%M:%S}, {missing} days without satellite data"
+                if error is not None:
+                    line += f", error: {error}"
+                click.echo(line)
+        counts = work_queue.counts()
+        click.echo(f"{sum(counts.values())} units: " + ', '.join(f'{count} {status}' for status,count in counts.items()))
+        sys.exit(0)
+    except Exception as e:
+        logger.error(f"Failed: {e}")
+        sys.exit(1)
+
+@colocate_batch.command(name="merge",help="Write the standard colocation results of a batch once all its units are done")
+@click.option("--queue", "-q", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="Queue directory created by colocate-batch init.")
+@click.option('--profile', '-p', default=None, type=click.Path(dir_okay=False), help="Write per stage wall time, peak memory and counts to this report file, as CSV if it ends in .csv, otherwise JSON.")
+def colocate_batch_merge(queue,profile):
+    try:
+        from .batch import WorkQueue, merge_batch
+
+        work_queue = WorkQueue(queue)
+        if not work_queue.exists():
+            logger.error(f"No queue in {queue}, create it with colocate-batch init")
+            sys.exit(1)
+
+        profiler = Profiler()
+        merge_batch(work_queue,profiler)
+
+        if profile is not None:
+            profiler.write(profile,'colocate-batch merge')
         sys.exit(0)
     except Exception as e:
         logger.error(f"Failed: {e}")
         sys.exit(1)
-        
-        
 
 @cli.command(help="Plot colocation results from ozonesonde/satellite colocation")
 @click.option('--available-datasets', '-dl', required=True,type=str,help='Indicate the source of the data in use. Must pass datasets as comma seperated list')
-@click.option("--input", "-i", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="input directory. The directory storing the colocated npz files.")
+@click.option("--input", "-i", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="input directory. The directory storing the colocation results.")
 @click.option("--output", "-o", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="output directory. The directory to save the generated figures. ")
-def plot_results(available_datasets,input,output):
+@click.option('--workers', '-w', default=1, show_default=True, type=click.IntRange(min=1), help="Number of worker processes rendering the figures.")
+@click.option('--max-points', '-mp', default=5000, show_default=True, type=click.IntRange(min=2), help="Time series with more colocations than this are averaged into this many time bins.")
+@click.option('--since', is_flag=True, default=False, help="Only re-render figures whose input results changed since the figure was last saved.")
+@click.option('--profile', '-p', default=None, type=click.Path(dir_okay=False), help="Write per stage wall time, peak memory and counts to this report file, as CSV if it ends in .csv, otherwise JSON.")
+def plot_results(available_datasets,input,output,workers,max_points,since,profile):
     
     # This subroutine plots column comparisons, based on co-locations in the 'colocate' subroutine.
     # The input comparison_list takes a list of the satellite colocations, based on the output of colocate,
@@ -415,44 +262,130 @@ def plot_results(available_datasets,input,output):
     
     # The values in the comparison list must equal the'self.identifier' value in the name of each of the colocated,
     # files, ensuring the script knows what files to use.
-    
-    # Initialise the Figure
     try:
-        sns.set_theme()
-        sns.set_context("notebook", font_scale=1.5, rc={"lines.linewidth": 2.5})
-        fig,ax = subplots(ncols=1,nrows=1,figsize=(20,10),dpi=200)
+        from .plotting import out_of_date, render_panels, standard_panels
+        from .results import ColocationResults
+        from .summary import SummaryStatistics
+
+        profiler = Profiler()
 
-        
         '''
         Author's note: The exact required statistics have not yet been defined, so this section is still very open for development
         '''
         # Split the input available datasets, so each one can be checked against what has been stored by colocate.
         available_datasets = list(available_datasets.split(','))
 
-        # Grab data from the Co-location sub-routine.
+        # Grab data from the Co-location sub-routine. At this time, it will plot all results that match, so if multiple
+        # sonde/satellite comparison results of the same type but different dates exist, they will all be plotted.
+        # Results being written are in .part directories, which are left out.
+        results = {}
         for root, directs, filenames in os.walk(os.path.abspath(input), topdown=False):
             for i in available_datasets:
-                for filename in fnmatch.filter(filenames, f"{i}*.npz"):
-                    # At this time, it will plot all files that match, so if multiple sonde/satellite comparison
-                    # files of the same type but different dates exist, they will all be plotted.
-                    npzfile = np.load(Path(f'{input}/{filename}'),allow_pickle=True)
-                    logger.info("Colocated file found, loading...")
-                    difference_profile_percent = npzfile['difference_profile_percent']
-                    difference_profile_absolute = npzfile['difference_profile_absolute']
-                    difference_troposphere_percent = npzfile['difference_troposphere_percent']
-                    difference_troposphere_absolute = npzfile['difference_troposphere_absolute']
-                    latitude_colocation = npzfile['latitude_colocation']
-                    time_vector = npzfile['time_vector']
-                    ax.plot(time_vector, difference_troposphere_percent,label=i)
-
-        ax.set_xlabel('Time')
-        ax.set_ylabel('Percent Difference HEGIFTOM Column Definition')
-        ax.legend()
-        savefig(Path(f'{output}/Sonde_Satellite_Ozone_Column_Comparison.png',format='png',bbox_inches = "tight"))
+                for dirname in fnmatch.filter(directs, f"{i}_sonde_colocation_*"):
+                    if dirname.endswith('.part'):
+                        continue
+                    logger.info(f"Colocated results {dirname} found")
+                    results.setdefault(i,[]).append(str(Path(root) / dirname))
+                    profiler.count('files_loaded')
+        results = {i: sorted(paths) for i,paths in results.items()}
+
+        # Monthly statistics per latitude band and pressure level of each dataset, accumulated chunk by chunk. With
+        # --since the saved summary is kept when none of the dataset's results changed after it was written.
+        summaries = {}
+        with profiler.stage('statistics'):
+            for i,paths in results.items():
+                summaries[i] = str(Path(output) / f'{i}_colocation_summary.npz')
+                if since and not out_of_date(summaries[i],paths):
+                    continue
+                summary = SummaryStatistics(i,ColocationResults(paths[0]).pressure_grid)
+                for path in paths:
+                    colocations = ColocationResults(path)
+                    summary.update_results(colocations)
+                    profiler.count('colocations_loaded',len(colocations))
+                summary.save(summaries[i])
+
+        # Render the standard figure set, skipping up to date figures with --since
+        panels = standard_panels(results,summaries,output,max_points)
+        if since:
+            panels = [panel for panel in panels if out_of_date(panel['output'],panel['inputs'])]
+        with profiler.stage('render'):
+            seconds = render_panels(panels,workers)
+        for panel,duration in zip(panels,seconds):
+            profiler.add_stage(f"render_{panel['kind']}",duration,1,peak_rss_mb())
+        profiler.count('panels_rendered',len(panels))
+        logger.info(f"Rendered {len(panels)} figures to {output}")
+
+        if profile is not None:
+            profiler.write(profile,'plot_results')
         
     except Exception as e:
         logger.error(f"Failed: {e}")
         sys.exit(1)
 
 
+@cli.command(help="Time each colocation stage on synthetic satellite and ozonesonde data")
+@click.option('--dataset', '-ds', default='TROPESS-CRIS', show_default=True, type=click.Choice(product_names(), case_sensitive=False),help='Product layout of the synthetic satellite files.')
+@click.option('--days', '-d', default=2, show_default=True, type=click.IntRange(min=1), help="Number of synthetic days.")
+@click.option('--soundings-per-day', '-spd', default=20000, show_default=True, type=click.IntRange(min=1), help="Number of satellite soundings per synthetic day.")
+@click.option('--sondes-per-day', '-sdd', default=20, show_default=True, type=click.IntRange(min=1), help="Number of ozonesondes per synthetic day.")
+@click.option('--distance-location', '-dl', default=100.0, show_default=True, type=float,help="Colocation distance criteria between satellite sounding and ozonesonde")
+@click.option('--distance-time', '-dt', default=3.0, show_default=True, type=float,help="Colocation time criteria between satellite sounding and ozonesonde")
+@click.option('--seed', default=0, show_default=True, type=int, help="Random seed of the synthetic data.")
+@click.option("--output", "-o", required=True, type=click.Path(dir_okay=False), help="JSON lines file the benchmark result is appended to.")
+@click.option("--workdir", "-w", default=None, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="Directory for the temporary synthetic files.")
+def benchmark(dataset,days,soundings_per_day,sondes_per_day,distance_location,distance_time,seed,output,workdir):
+    try:
+        from .benchmark import record_benchmark, run_benchmark
+
+        result = run_benchmark(dataset,datetime(2018,1,1),days,soundings_per_day,sondes_per_day,distance_location,distance_time,seed,workdir)
+        record_benchmark(result,output)
+    except Exception as e:
+        logger.error(f"Failed: {e}")
+        sys.exit(1)
+
+
+@cli.command(name="startup-benchmark",help="Time the start up of the command line, and check which heavy modules each command loads")
+@click.option('--repeats', '-r', default=5, show_default=True, type=click.IntRange(min=1), help="Number of runs of each command, the fastest is recorded.")
+@click.option("--output", "-o", required=True, type=click.Path(dir_okay=False), help="JSON lines file the benchmark result is appended to.")
+@click.option("--workdir", "-w", default=None, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="Directory for the temporary input and output directories.")
+def startup_benchmark(repeats,output,workdir):
+    try:
+        from .benchmark import record_benchmark, run_startup_benchmark
+
+        result = run_startup_benchmark(repeats,workdir)
+        record_benchmark(result,output)
+        for name,modules in result['loaded_modules'].items():
+            logger.info(f"Startup {name} loaded: {', '.join(modules) or 'no heavy modules'}")
+            if name != 'plot_results_help' and {'matplotlib','seaborn'} & set(modules):
+                logger.warning(f"Startup {name} loads the plotting stack")
+    except Exception as e:
+        logger.error(f"Failed: {e}")
+        sys.exit(1)
+
 
+@cli.command(name="memory-benchmark",help="Check that the peak memory of colocate does not grow with the length of the date range")
+@click.option('--dataset', '-ds', default='TROPESS-CRIS', show_default=True, type=click.Choice(product_names(), case_sensitive=False),help='Product layout of the synthetic satellite files.')
+@click.option('--short-days', default=15, show_default=True, type=click.IntRange(min=1), help="Number of days of the short run.")
+@click.option('--long-days', default=60, show_default=True, type=click.IntRange(min=1), help="Number of days of the long run.")
+@click.option('--window', '-wd', default=5, show_default=True, type=click.IntRange(min=0), help="colocate --window of both runs, the short run should span a few windows.")
+@click.option('--soundings-per-day', '-spd', default=1000, show_default=True, type=click.IntRange(min=1), help="Number of satellite soundings per synthetic day.")
+@click.option('--sondes-per-day', '-sdd', default=100, show_default=True, type=click.IntRange(min=1), help="Number of ozonesondes per synthetic day.")
+@click.option('--tolerance', default=0.1, show_default=True, type=float, help="Allowed relative growth of the peak memory from the short to the long run.")
+@click.option('--seed', default=0, show_default=True, type=int, help="Random seed of the synthetic data.")
+@click.option("--output", "-o", required=True, type=click.Path(dir_okay=False), help="JSON lines file the benchmark result is appended to.")
+@click.option("--workdir", "-w", default=None, type=click.Path(exists=True, file_okay=False, dir_okay=True), help="Directory for the temporary synthetic files.")
+def memory_benchmark(dataset,short_days,long_days,window,soundings_per_day,sondes_per_day,tolerance,seed,output,workdir):
+    try:
+        from .benchmark import record_benchmark, run_memory_benchmark
+
+        result = run_memory_benchmark(dataset,datetime(2018,1,1),short_days,long_days,window,soundings_per_day,sondes_per_day,seed,workdir)
+        record_benchmark(result,output)
+        for days,peak in result['peak_rss_mb'].items():
+            logger.info(f"colocate over {days} days, window {window}: peak RSS {peak:.1f} MB")
+        if result['growth'] > 1 + tolerance:
+            logger.error(f"Peak memory grew by a factor {result['growth']:.2f} from {short_days} to {long_days} days")
+            sys.exit(1)
+        logger.info(f"Peak memory flat within {tolerance:.0%} from {short_days} to {long_days} days")
+    except Exception as e:
+        logger.error(f"Failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,301 @@
+import logging
+import math
+import sys
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .logger import logger
+
+'''
+Colocation engine for matching ozonesondes with satellite soundings.
+
+Soundings are bucketed by calendar day and UT hour, and each bucket is held in a KD-tree built on
+unit-sphere coordinates. A sonde is then matched with a single radius query per relevant bucket,
+instead of being compared against every sounding in the date range.
+
+In station mode the sondes come from a fixed set of stations, so StationFootprints precomputes, once per launch
+position, the cells of the product's sounding grid that can hold a colocated sounding. Each day's soundings are only
+sorted by grid cell, and the candidates of a sonde are looked up from its footprint instead of searched for.
+'''
+
+# Radius of earth in kilometers, as used by the haversine distance
+EARTH_RADIUS_KM = 6371.0
+
+
+def distance(lat1, long1, lat2, long2):
+
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    """
+    # convert decimal degrees to radians
+    try:
+        lat1, long1, lat2, long2 = map(math.radians, [lat1, long1, lat2, long2])
+        # haversine formula
+        dlon = long2 - long1
+        dlat = lat2 - lat1
+        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+        c = 2 * math.asin(math.sqrt(a))
+        # Radius of earth in kilometers is 6371
+        km = EARTH_RADIUS_KM * c
+    except Exception as e:
+        logger.error(f"Error in calculating colocation distance {e}")
+        sys.exit(1)
+    return km
+
+
+def unit_vectors(latitudes, longitudes):
+
+    # Convert latitude/longitude in decimal degrees to cartesian coordinates on the unit sphere,
+    # so that great circle distances can be searched with a euclidean (chord) KD-tree.
+    lat = np.radians(np.asarray(latitudes, dtype=float))
+    lon = np.radians(np.asarray(longitudes, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_radius(distance_km):
+
+    # Convert a great circle distance in km to the equivalent chord length on the unit sphere.
+    # The radius is padded slightly, candidates are always confirmed with the haversine distance.
+    angle = min(distance_km / EARTH_RADIUS_KM, math.pi)
+    return 2.0 * math.sin(angle / 2.0) * (1.0 + 1e-6) + 1e-9
+
+
+class ColocationIndex:
+
+    '''
+    Spatial/temporal index over a set of satellite soundings.
+
+    Soundings are grouped by day and by integer UT hour, each group stored in a KD-tree. Queries return
+    the same soundings as comparing every sounding against the sonde with distance() and the hour criteria.
+    '''
+
+    def __init__(self, dates, hours, latitudes, longitudes):
+
+        self.hours = np.asarray(hours, dtype=float)
+        self.latitudes = np.asarray(latitudes)
+        self.longitudes = np.asarray(longitudes)
+        self.buckets = {}
+
+        if len(self.hours) == 0:
+            return
+
+        days = np.asarray(dates, dtype='datetime64[D]')
+        # Soundings without a finite time or position (e.g. decoded fill values) can never match and are left out
+        valid = np.isfinite(self.hours) & np.isfinite(self.latitudes) & np.isfinite(self.longitudes)
+        hour_bins = np.zeros(len(self.hours), dtype=np.int64)
+        hour_bins[valid] = np.floor(self.hours[valid]).astype(np.int64)
+        xyz = np.zeros((len(self.hours), 3))
+        xyz[valid] = unit_vectors(self.latitudes[valid], self.longitudes[valid])
+
+        # Sort soundings by (day, hour) and split into contiguous buckets
+        indices = np.nonzero(valid)[0]
+        order = indices[np.lexsort((hour_bins[indices], days[indices]))]
+        if len(order) == 0:
+            return
+        keys_day = days[order]
+        keys_hour = hour_bins[order]
+        breaks = np.nonzero((keys_day[1:] != keys_day[:-1]) | (keys_hour[1:] != keys_hour[:-1]))[0] + 1
+        for bucket in np.split(order, breaks):
+            self.buckets.setdefault(days[bucket[0]], {})[int(hour_bins[bucket[0]])] = (bucket, cKDTree(xyz[bucket]))
+
+    def query(self, sonde_datetime, sonde_latitude, sonde_longitude, distance_location, distance_time):
+
+        # Return the indices (ascending) of all soundings on the same day as the sonde, within distance_time hours
+        # of the sonde launch hour and within distance_location km of the sonde.
+        day_buckets = self.buckets.get(np.datetime64(sonde_datetime.date(), 'D'))
+        if not day_buckets:
+            return np.empty(0, dtype=np.int64)
+
+        sonde_hour = float(sonde_datetime.hour)
+        point = unit_vectors([sonde_latitude], [sonde_longitude])[0]
+        radius = chord_radius(distance_location)
+
+        candidates = []
+        for hour_bin, (bucket, tree) in day_buckets.items():
+            # Only search hour buckets that can hold soundings inside the time window
+            if hour_bin < sonde_hour + distance_time and hour_bin + 1 > sonde_hour - distance_time:
+                found = tree.query_ball_point(point, radius)
+                if found:
+                    candidates.append(bucket[found])
+
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+
+        matches = []
+        for j in np.sort(np.concatenate(candidates)):
+            if np.absolute(sonde_hour - float(self.hours[j])) < distance_time:
+                if distance(self.latitudes[j], self.longitudes[j], sonde_latitude, sonde_longitude) <= distance_location:
+                    matches.append(j)
+
+        return np.asarray(matches, dtype=np.int64)
+
+
+class StationFootprints:
+
+    '''
+    Candidate grid cells of sonde launch positions.
+
+    The globe is divided into cells of about cell_size degrees (the spacing of the product's sounding grid). The
+    footprint of a launch position is the set of cells that can hold a sounding within distance_location km of it,
+    computed on first use and kept, so that for a fixed set of stations every footprint is computed once and reused
+    for every day. Footprints are a superset of the matches, candidates are always confirmed with distance().
+    '''
+
+    def __init__(self, distance_location, cell_size):
+
+        self.distance_location = distance_location
+        self.rows = int(math.ceil(180.0 / cell_size))
+        self.columns = int(math.ceil(360.0 / cell_size))
+        # Cells evenly divide the globe, so longitudes wrap around onto the same cells
+        self.row_size = 180.0 / self.rows
+        self.column_size = 360.0 / self.columns
+        self.footprints = {}
+
+    def cells(self, latitudes, longitudes):
+
+        # Index of the cell holding each point
+        rows = np.clip(np.floor((np.asarray(latitudes, dtype=float) + 90.0) / self.row_size), 0, self.rows - 1)
+        columns = np.floor((np.asarray(longitudes, dtype=float) + 180.0) / self.column_size) % self.columns
+        return rows.astype(np.int64) * self.columns + columns.astype(np.int64)
+
+    def footprint(self, latitude, longitude):
+
+        # Sorted indices of the cells within distance_location km of a launch position, padded by one cell each side
+        key = (float(latitude), float(longitude))
+        if key not in self.footprints:
+            angle = math.degrees(min(self.distance_location / EARTH_RADIUS_KM, math.pi)) * (1.0 + 1e-6)
+            south, north = key[0] - angle, key[0] + angle
+            rows = np.arange(max(int(math.floor((max(south, -90.0) + 90.0) / self.row_size)) - 1, 0),
+                             min(int(math.floor((min(north, 90.0) + 90.0) / self.row_size)) + 1, self.rows - 1) + 1)
+            if south <= -90.0 or north >= 90.0:
+                columns = np.arange(self.columns)
+            else:
+                # Longitude half width of a spherical cap
+                half_width = math.degrees(math.asin(min(1.0, math.sin(math.radians(angle)) / math.cos(math.radians(key[0])))))
+                first = int(math.floor((key[1] - half_width + 180.0) / self.column_size)) - 1
+                last = int(math.floor((key[1] + half_width + 180.0) / self.column_size)) + 1
+                columns = np.arange(self.columns) if last - first + 1 >= self.columns else np.arange(first, last + 1) % self.columns
+            self.footprints[key] = np.unique((rows[:, np.newaxis] * self.columns + columns[np.newaxis, :]).ravel())
+        return self.footprints[key]
+
+    def index(self, latitudes, longitudes):
+
+        # Soundings sorted by cell, as (order, sorted cells), for candidates. Soundings without a finite position are
+        # put in cell -1, which no footprint holds.
+        latitudes, longitudes = np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+        finite = np.isfinite(latitudes) & np.isfinite(longitudes)
+        cells = np.full(len(latitudes), -1, dtype=np.int64)
+        cells[finite] = self.cells(latitudes[finite], longitudes[finite])
+        order = np.argsort(cells, kind='stable')
+        return order, cells[order]
+
+    def candidates(self, index, latitude, longitude):
+
+        # Indices (ascending) of the soundings in the footprint of a launch position
+        order, cells = index
+        footprint = self.footprint(latitude, longitude)
+        starts = np.searchsorted(cells, footprint, side='left')
+        ends = np.searchsorted(cells, footprint, side='right')
+        if not np.any(ends > starts):
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate([order[start:end] for start, end in zip(starts, ends) if end > start]))
+
+
+# Station footprints of this process, by colocation distance and cell size, kept across days
+STATION_FOOTPRINTS = {}
+
+
+def station_footprints(distance_location, cell_size):
+    key = (float(distance_location), float(cell_size))
+    if key not in STATION_FOOTPRINTS:
+        STATION_FOOTPRINTS[key] = StationFootprints(distance_location, cell_size)
+    return STATION_FOOTPRINTS[key]
+
+
+def match_stations(soundings, sondes, footprints, distance_time):
+
+    # Station mode counterpart of ColocationIndex: the indices (ascending) of the soundings colocated with each sonde,
+    # looked up from the footprint of its launch position and confirmed with the day, hour and distance criteria.
+    index = footprints.index(soundings.latitude, soundings.longitude)
+    hours = np.asarray(soundings.hour, dtype=float)
+    for k in range(0, len(sondes)):
+        ozone_date = sondes.launch_datetime(k)
+        sonde_hour = float(ozone_date.hour)
+        candidates = footprints.candidates(index, sondes.latitude[k], sondes.longitude[k])
+        candidates = candidates[(soundings.date[candidates] == np.datetime64(ozone_date.date(), 'D')) &
+                                (np.absolute(sonde_hour - hours[candidates]) < distance_time)]
+        yield k, np.asarray([j for j in candidates if distance(soundings.latitude[j], soundings.longitude[j], sondes.latitude[k],
+                                                               sondes.longitude[k]) <= footprints.distance_location], dtype=np.int64)
+
+
+def match_sondes(soundings, sondes, distance_location, distance_time, footprints=None):
+
+    # All sonde/sounding pairs meeting the colocation criteria, as arrays of sonde and sounding indices, ordered by
+    # sonde and then by sounding. In station mode footprints (a StationFootprints) replaces the per day search.
+    if footprints is not None:
+        pair_sondes, pair_soundings = [], []
+        for k, matches in match_stations(soundings, sondes, footprints, distance_time):
+            pair_sondes += [k] * len(matches)
+            pair_soundings += list(matches)
+        return np.asarray(pair_sondes, dtype=np.int64), np.asarray(pair_soundings, dtype=np.int64)
+
+    colocation_index = ColocationIndex(soundings.date, soundings.hour, soundings.latitude, soundings.longitude)
+
+    pair_sondes = []
+    pair_soundings = []
+    # Per match details are only formatted when DEBUG logging is on
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for k in range(0, len(sondes)):
+        ozone_date = sondes.launch_datetime(k)
+        sonde_latitude = sondes.latitude[k]
+        sonde_longitude = sondes.longitude[k]
+
+        # Satellite soundings on the same day, within distance_time hours and distance_location km of the sonde
+        for j in colocation_index.query(ozone_date, sonde_latitude, sonde_longitude, distance_location, distance_time):
+            if debug:
+                logger.debug("Match, Lat/long %s, %s, %s, %s, %s, %s, %s", soundings.latitude[j], soundings.longitude[j], sonde_latitude,
+                             sonde_longitude, ozone_date.year, ozone_date.month, ozone_date.day)
+            pair_sondes.append(k)
+            pair_soundings.append(j)
+
+    return np.asarray(pair_sondes, dtype=np.int64), np.asarray(pair_soundings, dtype=np.int64)
+
+
+def candidate_mask(dates, hours, latitudes, longitudes, sondes, distance_location, distance_time, footprints=None):
+
+    # Boolean mask of the soundings that may colocate with at least one of the sondes (as returned by
+    # Sondes.locations), i.e. same day, within distance_time hours and within distance_location km (chord radius,
+    # or the station footprint when footprints is given).
+    # This is a superset of the ColocationIndex matches, and is used to avoid reading soundings that can never match.
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    hours = np.asarray(hours, dtype=float)
+    mask = np.zeros(len(dates), dtype=bool)
+    sonde_dates, sonde_hours, sonde_latitudes, sonde_longitudes = sondes
+    if len(dates) == 0 or len(sonde_dates) == 0:
+        return mask
+
+    if footprints is not None:
+        index = footprints.index(latitudes, longitudes)
+        for s in range(len(sonde_dates)):
+            nearby = footprints.candidates(index, sonde_latitudes[s], sonde_longitudes[s])
+            mask[nearby[(dates[nearby] == sonde_dates[s]) & (np.absolute(sonde_hours[s] - hours[nearby]) < distance_time)]] = True
+        return mask
+
+    radius = chord_radius(distance_location)
+    # Soundings without a finite position can never match, and cannot be put in a KD-tree
+    finite = np.isfinite(latitudes) & np.isfinite(longitudes)
+    for day in np.intersect1d(np.unique(dates), np.unique(sonde_dates)):
+        on_day = np.nonzero((dates == day) & finite)[0]
+        if len(on_day) == 0:
+            continue
+        sondes_on_day = np.nonzero(sonde_dates == day)[0]
+        tree = cKDTree(unit_vectors(np.asarray(latitudes)[on_day], np.asarray(longitudes)[on_day]))
+        found = tree.query_ball_point(unit_vectors(sonde_latitudes[sondes_on_day], sonde_longitudes[sondes_on_day]), radius)
+        for s, nearby in zip(sondes_on_day, found):
+            if nearby:
+                nearby = on_day[nearby]
+                mask[nearby[np.absolute(sonde_hours[s] - hours[nearby]) < distance_time]] = True
+
+    return mask
@@ -0,0 +1,235 @@
+from collections import OrderedDict
+import numpy as np
+
+'''
+Batched comparison of colocated sonde/satellite pairs.
+
+Profiles are moved to the common pressure grid with precomputed linear interpolation weight matrices, one (grid, levels)
+matrix per profile, so that a whole batch of pairs is regridded and smoothed with a few einsum calls rather than
+building interpolation objects for every pair. Results follow scipy's interp1d (linear, extrapolated) for profiles and
+interp2d (bilinear, nearest value outside the source grid) for averaging kernels. Soundings of a product share a
+small set of level layouts, so the weight matrices of each distinct sounding pressure grid are kept in an LRU cache
+and only computed for grids that have not been seen recently.
+'''
+
+# Common pressure grid (hPa) to interpolate to, based on CAMS grid
+PRESSURE_GRID = np.asarray([10.0,20.0,30.0,50.0,70.0,100.0,150.0,200.0,250.0,300.0,400.0,500.0,600.0,700.0,800.0,850.0,900.0,925.0,950.0,1000.0],dtype=float)
+
+
+def interpolation_weights(source, target, clamp=False):
+
+    # Linear interpolation weights from each row of source (m, levels), ascending with any NaN padding at the end, to
+    # the target pressures. Returns an (m, len(target), levels) array W so that W @ y interpolates a profile y given on
+    # source. Targets outside the source range are extrapolated from the end intervals, or held at the nearest source
+    # value when clamp is set.
+    source = np.atleast_2d(np.asarray(source, dtype=float))
+    target = np.asarray(target, dtype=float)
+    m, levels = source.shape
+    valid = np.isfinite(source)
+    n_levels = valid.sum(axis=1)
+    rows = np.arange(m)[:, np.newaxis]
+
+    if clamp:
+        lowest = source[:, 0][:, np.newaxis]
+        highest = np.take_along_axis(source, np.maximum(n_levels - 1, 0)[:, np.newaxis], axis=1)
+        points = np.clip(target[np.newaxis, :], lowest, highest)
+    else:
+        points = np.broadcast_to(target[np.newaxis, :], (m, len(target)))
+
+    # Same interval choice as interp1d: the first source level >= the target, kept inside the valid levels
+    hi = (valid[:, np.newaxis, :] & (source[:, np.newaxis, :] < points[:, :, np.newaxis])).sum(axis=2)
+    hi = np.clip(hi, 1, np.maximum(n_levels - 1, 1)[:, np.newaxis])
+    lo = hi - 1
+    source_lo = np.take_along_axis(source, lo, axis=1)
+    source_hi = np.take_along_axis(source, hi, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = (points - source_lo) / (source_hi - source_lo)
+
+    weights = np.zeros((m, len(target), levels))
+    grid = np.arange(len(target))[np.newaxis, :]
+    weights[rows, grid, lo] = 1.0 - w
+    weights[rows, grid, hi] += w
+    return weights
+
+
+def level_operators(pressure, target):
+
+    # Profile and clamped (kernel) interpolation matrices of pressure rows (m, levels) to the target pressures, acting
+    # on the levels in their stored order. Levels are sorted by pressure (unused, non-finite levels last) to compute
+    # the weights, and the weights are then moved back to the position of each level, so regridding needs no sorting.
+    order = np.argsort(np.where(np.isfinite(pressure), pressure, np.inf), axis=1, kind='stable')
+    pressure = np.take_along_axis(pressure, order, axis=1)
+    rows = np.arange(len(pressure))[:, np.newaxis, np.newaxis]
+    grid = np.arange(len(target))[np.newaxis, :, np.newaxis]
+    operators = []
+    for weights in (interpolation_weights(pressure, target), interpolation_weights(pressure, target, clamp=True)):
+        unsorted = np.zeros_like(weights)
+        unsorted[rows, grid, order[:, np.newaxis, :]] = weights
+        operators.append(unsorted)
+    return operators
+
+
+class InterpolationCache:
+
+    '''
+    LRU cache of the interpolation operators of sounding pressure grids: for each distinct source grid (levels in the
+    product's own order, NaN for unused levels) and target grid, the (grid, levels) linear interpolation matrix used
+    for profiles, and the clamped matrix applied on both sides of averaging kernels (see level_operators). Holds at
+    most maxsize grids, and counts hits and misses.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.operators = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.operators)
+
+    def get(self, source, target):
+
+        # Profile and kernel interpolation matrices for each row of source (m, levels), as two (m, grid, levels)
+        # arrays. Rows are looked up by their distinct grids, the operators of new grids are computed in one batch.
+        source = np.atleast_2d(np.asarray(source, dtype=float))
+        target = np.asarray(target, dtype=float)
+        source = np.where(np.isfinite(source), source, np.nan)
+        if len(source) == 0:
+            return np.zeros((0, len(target), source.shape[1])), np.zeros((0, len(target), source.shape[1]))
+        # Distinct grids, compared as raw bytes (much faster than np.unique along an axis)
+        rows = np.ascontiguousarray(source).view(np.dtype((np.void, source.dtype.itemsize * source.shape[1]))).ravel()
+        distinct, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        grids = source[first]
+        keys = [(target.tobytes(), grid.tobytes()) for grid in grids]
+
+        new = [n for n, key in enumerate(keys) if key not in self.operators]
+        if new:
+            weights, clamped = level_operators(grids[new], target)
+            for n, k in enumerate(new):
+                self.operators[keys[k]] = (weights[n], clamped[n])
+        self.misses += len(new)
+        self.hits += len(keys) - len(new)
+
+        operators = []
+        for key in keys:
+            self.operators.move_to_end(key)
+            operators.append(self.operators[key])
+        while len(self.operators) > self.maxsize:
+            self.operators.popitem(last=False)
+
+        weights = np.stack([weights for weights, _ in operators])
+        clamped = np.stack([clamped for _, clamped in operators])
+        return weights[inverse], clamped[inverse]
+
+    def clear(self):
+        self.operators.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Interpolation operators of this process, shared by every day and product colocated in it
+INTERPOLATION_CACHE = InterpolationCache()
+
+
+def regrid_sonde(pressure, ozone, pressure_grid):
+
+    # Interpolate one sonde profile (ascending pressure) to the pressure grid
+    order = np.argsort(pressure, kind='stable')
+    weights = interpolation_weights(np.asarray(pressure, dtype=float)[order], pressure_grid)[0]
+    return weights @ np.asarray(ozone, dtype=float)[order]
+
+
+def regrid_soundings(soundings, indices, pressure_grid, cache=INTERPOLATION_CACHE):
+
+    # Interpolate the ozone profile, a priori and averaging kernel of the selected soundings to the pressure grid.
+    # Levels are sorted by pressure first (as interp1d/interp2d do), so both surface first and top first products work.
+    # The interpolation matrices come from cache (an InterpolationCache), or are computed for every sounding if None.
+    if cache is not None:
+        pressure = soundings.pressure[indices]
+        valid = np.isfinite(pressure)
+        weights, clamped = cache.get(pressure, pressure_grid)
+        averaging_kernel = np.where(valid[:, :, np.newaxis] & valid[:, np.newaxis, :], soundings.averaging_kernel[indices], 0.0)
+        return (np.einsum('mgl,ml->mg', weights, np.where(valid, soundings.ozone[indices], 0.0)),
+                np.einsum('mgl,ml->mg', weights, np.where(valid, soundings.ozone_apriori[indices], 0.0)),
+                clamped @ averaging_kernel @ np.swapaxes(clamped, 1, 2))
+
+    pressure = soundings.pressure[indices]
+    order = np.argsort(np.where(np.isfinite(pressure), pressure, np.inf), axis=1, kind='stable')
+    pressure = np.take_along_axis(pressure, order, axis=1)
+    valid = np.isfinite(pressure)
+
+    def sort_levels(values):
+        values = np.take_along_axis(values, order, axis=1)
+        return np.where(valid, values, 0.0)
+
+    ozone = sort_levels(soundings.ozone[indices])
+    apriori = sort_levels(soundings.ozone_apriori[indices])
+    averaging_kernel = np.take_along_axis(soundings.averaging_kernel[indices], order[:, :, np.newaxis], axis=1)
+    averaging_kernel = np.take_along_axis(averaging_kernel, order[:, np.newaxis, :], axis=2)
+    averaging_kernel = np.where(valid[:, :, np.newaxis] & valid[:, np.newaxis, :], averaging_kernel, 0.0)
+
+    weights = interpolation_weights(pressure, pressure_grid)
+    clamped = interpolation_weights(pressure, pressure_grid, clamp=True)
+    return (np.einsum('mgl,ml->mg', weights, ozone),
+            np.einsum('mgl,ml->mg', weights, apriori),
+            clamped @ averaging_kernel @ np.swapaxes(clamped, 1, 2))
+
+
+def smooth_profiles(averaging_kernel, apriori, model, AK_Log=True):
+
+    # Averaging kernel smoothing of the model profiles, H(x) = xa + A(x - xa) for every row, in log space when AK_Log is
+    # set (Equation 7 in https://doi.org/10.5194/egusphere-2022-774). Returns the smoothed profiles and a mask of the
+    # rows where this was well defined (positive profiles in log space, finite results).
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if AK_Log:
+            valid = np.all(apriori > 0, axis=1) & np.all(model > 0, axis=1)
+            modified_profile = np.exp(np.log(apriori) + np.einsum('mij,mj->mi', averaging_kernel, np.log(model) - np.log(apriori)))
+        else:
+            valid = np.ones(len(model), dtype=bool)
+            modified_profile = apriori + np.einsum('mij,mj->mi', averaging_kernel, model - apriori)
+    valid &= np.all(np.isfinite(modified_profile), axis=1)
+    return modified_profile, valid
+
+
+def profile_differences(satellite, smoothed):
+
+    # Percent and absolute differences between satellite and smoothed sonde profiles, and a mask of the finite rows
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        percent = 100 * ((satellite - smoothed) / smoothed)
+        absolute = (satellite - smoothed) * 1e9
+    valid = np.all(np.isfinite(percent), axis=1) & np.all(np.isfinite(absolute), axis=1)
+    return percent, absolute, valid
+
+
+# Tropospheric column top (hPa) as defined by HEGIFTOM, for the tropics (within 15°), subtropics (15°-30°),
+# midlatitudes (30°-60°) and polar regions (> 60°)
+HEGIFTOM_TROPOPAUSE = np.asarray([150.0, 200.0, 300.0, 400.0])
+
+
+def tropospheric_cutoff(latitudes):
+
+    # Top of the HEGIFTOM tropospheric column (hPa) for each latitude
+    latitudes = np.absolute(np.asarray(latitudes, dtype=float))
+    band = np.digitize(latitudes, [15.0, 30.0, 60.0])
+    return HEGIFTOM_TROPOPAUSE[band]
+
+
+def column_du(pressure, vmr, cutoff=None):
+
+    # Integrate profiles of ozone in ppm into column values in DU, for a batch of profiles (m, levels) on a shared
+    # (levels,) or per row (m, levels) pressure grid, in either level order. Each layer uses the ozone value at its
+    # pressure midpoint (the mean of its two levels). With a per row cutoff (hPa) only the layers from the surface up
+    # to the cutoff pressure are included.
+    vmr = np.atleast_2d(np.asarray(vmr, dtype=float))
+    pressure = np.broadcast_to(np.asarray(pressure, dtype=float), vmr.shape)
+    order = np.argsort(pressure, axis=1, kind='stable')
+    pressure = np.take_along_axis(pressure, order, axis=1)
+    vmr = np.take_along_axis(vmr, order, axis=1)
+
+    o3_mid = (vmr[:, 1:] + vmr[:, :-1]) / 2
+    thickness = pressure[:, 1:] - pressure[:, :-1]
+    o3DU = ((o3_mid/1000)*1e-6) * ((thickness/9.8)*100*(1e-4)*(1/(28.96e-3))*(6.022e23)*(1/(2.6867e16)))
+    if cutoff is not None:
+        included = pressure[:, :-1] >= np.asarray(cutoff, dtype=float).reshape(-1, 1)
+        o3DU = np.where(included, o3DU, 0.0)
+    return o3DU.sum(axis=1)
@@ -1,9 +1,9 @@
 import sys
 import logging
 
-# create logger
+# create logger, per match and per missing day details are logged at DEBUG level
 logger = logging.getLogger('Py-sonde-comparison')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 
 # create console handler and set level to debug
 ch = logging.StreamHandler(stream=sys.stdout)
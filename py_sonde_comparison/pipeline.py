@@ -0,0 +1,366 @@
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
+from pathlib import Path
+from itertools import islice
+import numpy as np
+
+from .logger import logger
+from .colocation import candidate_mask, match_sondes, station_footprints
+from .comparison import INTERPOLATION_CACHE, PRESSURE_GRID, column_du, profile_differences, regrid_sonde, regrid_soundings, smooth_profiles, tropospheric_cutoff
+from .products import get_product
+from .profiling import Profiler
+from .readers import read_day
+from .results import write_results_parts
+from .shards import ColocationShards
+from .sondes import contiguous_runs, grab_woudc
+
+'''
+Colocation pipeline of the colocate and colocate-batch commands.
+
+colocate_range colocates a date range into per day shards, and write_range_results assembles the shards of a date
+range into the results directory of each dataset. The sondes of a date range are fetched one window of days at a time,
+so memory depends on the window rather than on the range length, and split by launch day. Each day is colocated
+independently by colocate_day: the day's satellite soundings are read, matched with the sondes and compared on the
+common pressure grid. Several products can be colocated in one pass, a day's sondes are then interpolated to the
+common grid once and matched with the soundings of every product. In station mode (a list of GAW IDs) sondes are
+matched through station footprints precomputed once per process and reused every day.
+
+When days are colocated in one process, prefetch reads the satellite files of the next days in background threads
+while the current day is colocated, so file I/O overlaps with computation. Kept apart from cli.py so that the command
+line can start without importing the scientific stack, and so worker processes only import what colocation needs.
+'''
+
+def convert_ppm_to_du(pressure,vmr):
+
+    # This subroutine converts a profile of ozone values in ppm
+    # into a single column value expressed as DU. Works between any particular pressure range.
+    # Single profile form of comparison.column_du.
+    return column_du(pressure,vmr)[0]
+
+def convert_units(soundings,ozone_units):
+
+    # Convert the satellite ozone profile and a priori to ppb, we currently do not know what units ozone will be
+    if ozone_units == str(None):
+        soundings.ozone = soundings.ozone*1e9
+        soundings.ozone_apriori = soundings.ozone_apriori*1e9
+    elif ozone_units == 'ppb':
+        pass
+    elif ozone_units == 'ppm':
+        soundings.ozone = soundings.ozone*1000
+        soundings.ozone_apriori = soundings.ozone_apriori*1000
+    else:
+        print("Unit choice not supported,'None', 'ppb', or 'ppm' are currently supported.")
+        logger.error("Unit choice not supported,'None', 'ppb', or 'ppm' are currently supported.")
+        sys.exit(1)
+
+    return soundings
+
+def split_sondes_by_day(sondes,start_date,end_date):
+
+    # Group the sondes by launch day, returning (day, sondes, sonde indices) for every day in [start_date, end_date)
+    # with at least one sonde. Sondes are only ever matched with soundings of the same day, so each day can be
+    # colocated independently.
+    tasks = []
+    for j in range(0,(end_date - start_date).days):
+        day = start_date + timedelta(days=j)
+        sonde_ids = np.nonzero(sondes.date == np.datetime64(day.date(),'D'))[0]
+        if len(sonde_ids):
+            tasks.append((day,sondes.subset(sonde_ids),sonde_ids))
+    return tasks
+
+def split_windows(days,window):
+
+    # Split sorted days into windows spanning at most window days each (one window for all days if window is 0), so
+    # a long date range can be colocated one window at a time
+    windows = []
+    for day in days:
+        if windows and (window == 0 or (day - windows[-1][0]).days < window):
+            windows[-1].append(day)
+        else:
+            windows.append([day])
+    return windows
+
+def colocate_soundings(soundings,sondes,sonde_ids,distance_location,distance_time,profiler,footprints=None,sonde_profiles=None):
+
+    # Colocate the given sondes with a set of satellite soundings (in ppb), returning one record per accepted
+    # match: (sonde index, sounding index, profile percent difference, profile absolute difference,
+    # troposphere percent difference, troposphere absolute difference, sounding latitude, sounding longitude, sonde
+    # station, sonde launch time).
+    # Stage times and match counts are added to profiler. footprints is the StationFootprints of station mode.
+    # sonde_profiles holds the sondes already interpolated to the common grid (by sonde index), it is filled in here
+    # so it can be shared by every product colocated with the same sondes.
+    latitudes = soundings.latitude
+    longitudes = soundings.longitude
+    records = []
+
+    # Common pressure grid to interpolate to, based on CAMS grid
+    pressure_grid = PRESSURE_GRID
+
+    # Find all sonde/sounding pairs first, so the comparison can be done in one batch
+    with profiler.stage('match'):
+        pair_sondes, pair_soundings = match_sondes(soundings,sondes,distance_location,distance_time,footprints)
+    profiler.count('candidate_pairs',len(pair_sondes))
+    if len(pair_sondes) == 0:
+        return records
+
+    # Interpolate sondes and satellites to common grid, each matched sonde is only interpolated once. The satellite
+    # interpolation matrices are cached per distinct sounding pressure grid.
+    hits, misses = INTERPOLATION_CACHE.hits, INTERPOLATION_CACHE.misses
+    with profiler.stage('interpolate'):
+        sonde_profiles = {} if sonde_profiles is None else sonde_profiles
+        for k in np.unique(pair_sondes):
+            if k not in sonde_profiles:
+                sonde_profiles[k] = regrid_sonde(*sondes.profile(k),pressure_grid)
+                profiler.count('sondes_interpolated')
+        sonde_profile_mod = np.asarray([sonde_profiles[k] for k in pair_sondes])
+        satellite_profile_mod, satellite_profile_apriori_mod, satellite_profile_ak_mod = regrid_soundings(soundings,pair_soundings,pressure_grid)
+    profiler.count('interpolation_cache_hits',INTERPOLATION_CACHE.hits - hits)
+    profiler.count('interpolation_cache_misses',INTERPOLATION_CACHE.misses - misses)
+
+    # Modify Sondes to sensitivity of instrument
+    with profiler.stage('smooth'):
+        sond_profile_ak, smoothed = smooth_profiles(satellite_profile_ak_mod,satellite_profile_apriori_mod,sonde_profile_mod)
+        difference_percent, difference_absolute, finite = profile_differences(satellite_profile_mod,sond_profile_ak)
+
+    # Remove strange behaviour, and ignore large differences
+    usable = smoothed & finite & np.all(np.isfinite(satellite_profile_mod),axis=1)
+    if np.any(~usable):
+        logger.info(f"Runtime error in {np.count_nonzero(~usable)} sonde/satellite comparisons, skipping....")
+    accepted = usable & (np.absolute(np.where(usable,difference_percent[:,-1],0.0)) < 200)
+    if np.any(usable & ~accepted):
+        logger.info(f"Warning sonde/satellite difference over 200% in {np.count_nonzero(usable & ~accepted)} comparisons, skipping....")
+    profiler.count('rejected_runtime_error',np.count_nonzero(~usable))
+    profiler.count('rejected_over_200_percent',np.count_nonzero(usable & ~accepted))
+    profiler.count('accepted',np.count_nonzero(accepted))
+
+    # Tropospheric column differences, from the ground to the HEGIFTOM tropopause for the sounding latitude
+    accepted = np.nonzero(accepted)[0]
+    with profiler.stage('column'):
+        cutoff = tropospheric_cutoff(latitudes[pair_soundings[accepted]])
+        difference_troposphere_percent = 100 * column_du(pressure_grid,(satellite_profile_mod[accepted] - sond_profile_ak[accepted]) / sond_profile_ak[accepted],cutoff)
+        difference_troposphere_absolute = column_du(pressure_grid,(satellite_profile_mod[accepted] - sond_profile_ak[accepted])* 1e6,cutoff)
+
+    for n,p in enumerate(accepted):
+        k = pair_sondes[p]
+        j = pair_soundings[p]
+        records.append((sonde_ids[k],j,
+                        difference_percent[p],
+                        difference_absolute[p],
+                        difference_troposphere_percent[n],
+                        difference_troposphere_absolute[n],
+                        latitudes[j],
+                        longitudes[j],
+                        sondes.station[k],
+                        sondes.launch[k]))
+
+    return records
+
+def product_footprints(dataset,distance_location,gaw_locations):
+
+    # Station footprints of a product in station mode, shared by every day colocated in this process, or None
+    if gaw_locations == 'all':
+        return None
+    return station_footprints(distance_location,get_product(dataset).grid_size)
+
+def read_task(task):
+
+    # Read the satellite soundings of every product of one colocation task, converted to ppb. Returns the soundings
+    # by dataset (None when the day is not available) and the profiling report of the reads. Files are closed before
+    # returning, only the arrays are kept, so it can run in a prefetch thread.
+    products,day,sondes,sonde_ids,distance_location,distance_time,sonde_prefilter,gaw_locations = task
+    profiler = Profiler()
+    locations = sondes.locations()
+
+    soundings = {}
+    for dataset,input,ozone_units in products:
+        # In prefilter mode only soundings near a sonde (in space and time) have their profiles and kernels read,
+        # so memory scales with the number of candidate matches rather than the number of soundings.
+        select = None
+        if sonde_prefilter:
+            footprints = product_footprints(dataset,distance_location,gaw_locations)
+            select = lambda date,hour,latitude,longitude: candidate_mask(date,hour,latitude,longitude,locations,distance_location,distance_time,footprints)
+
+        with profiler.stage('read'):
+            soundings[dataset] = read_day(input,get_product(dataset),day,select)
+            if soundings[dataset] is not None:
+                soundings[dataset] = convert_units(soundings[dataset],ozone_units)
+    return soundings, profiler.report()
+
+def prefetch(function,tasks,readahead):
+
+    # Yield (task, function(task)) in task order, with function already running for up to readahead of the following
+    # tasks in background threads while the caller works on the current one. At most readahead results are waiting
+    # in the queue, so at most readahead + 1 days are held in memory. With readahead 0 everything runs in the caller.
+    tasks = iter(tasks)
+    if readahead < 1:
+        for task in tasks:
+            yield task, function(task)
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=readahead) as pool:
+        try:
+            for task in islice(tasks,readahead):
+                pending.append((task,pool.submit(function,task)))
+            while pending:
+                task,future = pending.popleft()
+                result = future.result()
+                for following in islice(tasks,1):
+                    pending.append((following,pool.submit(function,following)))
+                yield task, result
+        finally:
+            # Stopped early (error or closed generator), do not start reading the queued days
+            for _,future in pending:
+                future.cancel()
+
+def colocate_day(task,read=None):
+
+    # Colocate one day of satellite data of every product of the task with that day's sondes. Runs in a worker
+    # process when colocate is given --workers, so it only takes picklable arguments. read is the result of read_task
+    # for the day when it was prefetched, otherwise the day is read here. Returns the day's records by dataset (None
+    # for a product without data that day) and its profiling report, which the parent process merges.
+    products,day,sondes,sonde_ids,distance_location,distance_time,sonde_prefilter,gaw_locations = task
+    soundings,report = read_task(task) if read is None else read
+    profiler = Profiler()
+    profiler.merge(report)
+    profiler.count('days_with_sondes')
+
+    # Sondes are interpolated to the common grid once, and shared by every product
+    sonde_profiles = {}
+    records = {}
+    for dataset,_,_ in products:
+        if soundings[dataset] is None:
+            profiler.count('days_missing')
+            logger.info(f"{day.year:02}_{day.month:02}_{day.day:02} {dataset}: {len(sondes)} sondes, satellite data not available, skipping....")
+            records[dataset] = None
+            continue
+        profiler.count('soundings_read',len(soundings[dataset]))
+
+        matches = profiler.counts.get('candidate_pairs',0)
+        records[dataset] = colocate_soundings(soundings[dataset],sondes,sonde_ids,distance_location,distance_time,profiler,
+                                              product_footprints(dataset,distance_location,gaw_locations),sonde_profiles)
+        logger.info(f"{day.year:02}_{day.month:02}_{day.day:02} {dataset}: {len(sondes)} sondes, {len(soundings[dataset])} soundings, {profiler.counts['candidate_pairs'] - matches} matches, {len(records[dataset])} accepted")
+    return records, profiler.report()
+
+def results_path(output,dataset,start_date,end_date):
+
+    # Results directory of a dataset and date range
+    return Path(f'{output}/{dataset}_sonde_colocation_{start_date.year}_{start_date.month}_{start_date.day}_{end_date.year}_{end_date.month}_{end_date.day}')
+
+def pending_days(product,start_date,end_date,output,gaw_locations,distance_location,distance_time):
+
+    # Days in [start_date, end_date) not colocated yet with a product, given as (dataset, input directory, ozone units).
+    # Results written while days were pending (e.g. without satellite data yet) are partial, and are written again
+    # once a rerun colocated these days.
+    dataset,_,units = product
+    shards = ColocationShards(output,dataset,gaw_locations,units,distance_location,distance_time)
+    days = [start_date + timedelta(days=j) for j in range(0,(end_date - start_date).days)]
+    return [day for day in days if not shards.completed(day)]
+
+def colocate_range(products,start_date,end_date,output,gaw_locations,distance_location,distance_time,sonde_prefilter=False,
+                   sonde_cache=None,offline=False,workers=1,window=30,readahead=2,profiler=None):
+
+    # Colocate the days in [start_date, end_date) with every product, given as (dataset, input directory, ozone units),
+    # checkpointing each finished day as a shard (see shards.py). Days that already have a shard are skipped, so
+    # running a date range again only colocates what is missing. Returns the number of days without satellite data of
+    # each dataset.
+    profiler = profiler if profiler is not None else Profiler()
+
+    # Finished days are checkpointed as shards per dataset, only days without a shard are colocated
+    shards = {i: ColocationShards(output,i,gaw_locations,units,distance_location,distance_time) for i,_,units in products}
+    days = [start_date + timedelta(days=j) for j in range(0,(end_date - start_date).days)]
+    pending = {i: {day for day in days if not shards[i].completed(day)} for i,_,_ in products}
+    for i,_,_ in products:
+        if len(pending[i]) < len(days):
+            logger.info(f"{len(days) - len(pending[i])} of {len(days)} days found in {shards[i].root}, reusing their colocations")
+
+    if offline and sonde_cache is None:
+        raise ValueError("Offline mode requires a --sonde-cache directory")
+    if any(units == str(None) for _,_,units in products):
+        logger.info("Satellite ozone profile units not selected, converting to ppb")
+
+    # Each day's shards are written as soon as the day is done. Days without satellite data are left out, so
+    # they are retried by the next run.
+    missing = {i: 0 for i,_,_ in products}
+    def checkpoint(task,result):
+        records,report = result
+        profiler.merge(report)
+        for i,day_records in records.items():
+            if day_records is None:
+                missing[i] += 1
+                continue
+            with profiler.stage('save'):
+                shards[i].save(task[1],day_records)
+
+    # The pending days are colocated one window at a time: the window's sondes are fetched, its days colocated
+    # and checkpointed, and nothing but the shards is kept for the next window
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as pool:
+        for window_days in split_windows(sorted(set().union(*pending.values())),window):
+
+            # Grabs the relevant sonde data once for all datasets, for each run of consecutive days to colocate
+            tasks = []
+            for run in contiguous_runs(window_days):
+                with profiler.stage('sonde_fetch'):
+                    sondes = grab_woudc(run[0],run[-1] + timedelta(days=1),gaw_locations,sonde_cache,offline)
+                profiler.count('sondes_fetched',len(sondes))
+
+                # Each day is independent, as sondes are only matched with soundings of the same day. A day is
+                # colocated with every dataset that has no shard for it yet.
+                run_tasks = [(tuple(product for product in products if day in pending[product[0]]),day,day_sondes,sonde_ids,distance_location,distance_time,sonde_prefilter,gaw_locations)
+                             for day,day_sondes,sonde_ids in split_sondes_by_day(sondes,run[0],run[-1] + timedelta(days=1))]
+                tasks += run_tasks
+
+                # Days without sondes have no colocations, they are checkpointed as empty shards so that reruns do not
+                # fetch their sondes again. Offline, a day missing from the sonde cache has no sondes either, so these
+                # days are left to be colocated once the cache has them.
+                if not offline:
+                    with_sondes = {task[1] for task in run_tasks}
+                    for day in run:
+                        if day not in with_sondes:
+                            for i,_,_ in products:
+                                if day in pending[i]:
+                                    with profiler.stage('save'):
+                                        shards[i].save(day,[])
+                            profiler.count('days_without_sondes')
+            del sondes
+
+            if pool is not None:
+                for task,result in zip(tasks,pool.map(colocate_day,tasks)):
+                    checkpoint(task,result)
+            else:
+                # Satellite files of the next days are read in the background while a day is colocated,
+                # read_wait is the time spent waiting for a day that was not read yet
+                days_read = prefetch(read_task,tasks,readahead)
+                while True:
+                    with profiler.stage('read_wait'):
+                        task,read = next(days_read,(None,None))
+                    if task is None:
+                        break
+                    checkpoint(task,colocate_day(task,read))
+            del tasks
+            profiler.count('windows')
+
+    return missing
+
+def write_range_results(products,start_date,end_date,output,gaw_locations,distance_location,distance_time,profiler=None,missing=None):
+
+    # Assemble the results directory of each product over [start_date, end_date) from its shards, one day at a time, in
+    # day order and within a day in sonde order, then sounding order
+    profiler = profiler if profiler is not None else Profiler()
+    days = [start_date + timedelta(days=j) for j in range(0,(end_date - start_date).days)]
+    for i,_,units in products:
+        shards = ColocationShards(output,i,gaw_locations,units,distance_location,distance_time)
+        colocations = shards.count(days)
+        if missing is None:
+            logger.info(f"{i}: {colocations} colocations")
+        else:
+            logger.info(f"{i}: {colocations} colocations, {missing[i]} days without satellite data")
+        pending = sum(not shards.completed(day) for day in days)
+        if pending:
+            logger.warning(f"{i}: {pending} of {len(days)} days not colocated yet, the results are partial until a rerun colocates them")
+
+        with profiler.stage('save'):
+            write_results_parts(results_path(output,i,start_date,end_date),shards.iter_load(days),colocations,PRESSURE_GRID)
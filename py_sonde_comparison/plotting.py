@@ -0,0 +1,246 @@
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from .results import ColocationResults
+from .summary import LATITUDE_BANDS, SummaryStatistics
+
+'''
+Standard figures of the colocation results.
+
+plot_results builds a list of panels, each a dict naming the panel kind, the results directories or summary files it
+is drawn from and the PNG it is saved to, and renders them with render_panels, optionally in worker processes. Panels
+are drawn on Agg canvases without pyplot, and every process keeps one Figure per figure size that is cleared and reused
+for the next panel. Time series with more points than max_points are binned in time, drawing the mean of each bin with
+its minimum to maximum range. A panel only needs to be rendered again when one of its inputs is newer than its PNG.
+'''
+
+# Reused figures of this process, by figure size and resolution
+FIGURES = {}
+
+
+def set_style():
+
+    # Plot style shared by every panel, applied in each rendering process
+    import seaborn as sns
+    sns.set_theme(style="darkgrid")
+    sns.set_context("notebook", font_scale=1.5, rc={"lines.linewidth": 2.5})
+
+
+def get_figure(figsize, dpi):
+
+    # Empty Figure of the given size, reusing the one from a previous panel of this process
+    figure = FIGURES.get((figsize, dpi))
+    if figure is None:
+        figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(figure)
+        FIGURES[(figsize, dpi)] = figure
+    else:
+        figure.clear()
+    return figure
+
+
+def modified_time(path):
+
+    # Last modification time of a file, or of the newest file in a directory
+    path = Path(path)
+    if path.is_dir():
+        return max((entry.stat().st_mtime for entry in path.iterdir()), default=path.stat().st_mtime)
+    return path.stat().st_mtime
+
+
+def out_of_date(output, inputs):
+
+    # Whether output is missing or older than any of its inputs
+    output = Path(output)
+    return not output.exists() or any(modified_time(path) > output.stat().st_mtime for path in inputs)
+
+
+def downsample(times, values, max_points):
+
+    # Sort a time series by time and, if it is longer than max_points, average it into max_points equal time bins.
+    # Returns the times, values and (when binned) the minimum and maximum of each non-empty bin.
+    order = np.argsort(times, kind='stable')
+    times, values = np.asarray(times)[order], np.asarray(values, dtype=float)[order]
+    if len(times) <= max_points:
+        return times, values, None, None
+
+    seconds = times.astype('datetime64[s]').astype(np.int64)
+    edges = np.linspace(seconds[0], seconds[-1], max_points + 1)
+    bins = np.clip(np.searchsorted(edges, seconds, side='right') - 1, 0, max_points - 1)
+    valid = np.isfinite(values)
+    count = np.bincount(bins[valid], minlength=max_points)
+    total = np.bincount(bins[valid], weights=values[valid], minlength=max_points)
+    low = np.full(max_points, np.inf)
+    np.minimum.at(low, bins[valid], values[valid])
+    high = np.full(max_points, -np.inf)
+    np.maximum.at(high, bins[valid], values[valid])
+
+    filled = count > 0
+    centres = ((edges[:-1] + edges[1:]) / 2).astype(np.int64).astype('datetime64[s]')
+    return centres[filled], total[filled] / count[filled], low[filled], high[filled]
+
+
+def plot_series(ax, times, values, max_points, label=None):
+    times, values, low, high = downsample(times, values, max_points)
+    line, = ax.plot(times, values, label=label)
+    if low is not None:
+        ax.fill_between(times, low, high, color=line.get_color(), alpha=0.3, linewidth=0)
+
+
+def read_series(paths, name, station=None):
+
+    # Launch times and one variable of the colocations in the given results directories, optionally of one station
+    times, values = [], []
+    for path in paths:
+        results = ColocationResults(path)
+        indices = results.select(station=station)
+        times.append(np.asarray(results['time_vector'][indices]))
+        values.append(np.asarray(results[name][indices]))
+    return np.concatenate(times), np.concatenate(values)
+
+
+def plot_column_comparison(panel):
+
+    # Tropospheric column percent differences of every dataset against time
+    figure = get_figure((20, 10), 200)
+    ax = figure.subplots()
+    for dataset, paths in panel['results'].items():
+        plot_series(ax, *read_series(paths, 'difference_troposphere_percent'), panel['max_points'], label=dataset)
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Percent Difference HEGIFTOM Column Definition')
+    ax.legend()
+    figure.savefig(panel['output'], format='png', bbox_inches='tight')
+
+
+def plot_column_statistics(panel):
+
+    # Monthly median and interquartile range of the tropospheric column percent differences of every dataset
+    figure = get_figure((20, 10), 200)
+    ax = figure.subplots()
+    for dataset, path in panel['summaries'].items():
+        summary = SummaryStatistics.load(path)
+        # A dataset without colocations has no months, and no line
+        if not len(summary.months):
+            continue
+        statistics = summary.variables['difference_troposphere_percent'].total(axis=(1, 2))
+        months = summary.months.astype('datetime64[D]')
+        ax.plot(months, statistics.percentile(50)[:, 0, 0], label=dataset)
+        ax.fill_between(months, statistics.percentile(25)[:, 0, 0], statistics.percentile(75)[:, 0, 0], alpha=0.3)
+    ax.set_xlabel('Month')
+    ax.set_ylabel('Percent Difference HEGIFTOM Column Definition')
+    if ax.get_legend_handles_labels()[0]:
+        ax.legend()
+    figure.savefig(panel['output'], format='png', bbox_inches='tight')
+
+
+def plot_curtain(panel):
+
+    # Monthly mean profile percent difference against pressure, over all latitudes
+    summary = SummaryStatistics.load(panel['summary'])
+    figure = get_figure((20, 10), 200)
+    ax = figure.subplots()
+
+    # A dataset without colocations has no months, its curtain is left empty
+    if len(summary.months):
+        statistics = summary.variables['difference_profile_percent'].total(axis=1)
+        mean = np.where(statistics.count[:, 0, :] > 0, statistics.mean[:, 0, :], np.nan)
+        months = np.append(summary.months, summary.months[-1] + 1).astype('datetime64[D]')
+        pressure = np.log(summary.pressure_grid)
+        pressure = np.exp(np.concatenate(([1.5 * pressure[0] - 0.5 * pressure[1]], (pressure[1:] + pressure[:-1]) / 2,
+                                          [1.5 * pressure[-1] - 0.5 * pressure[-2]])))
+        mesh = ax.pcolormesh(months, pressure, mean.T, cmap='RdBu_r', vmin=-50.0, vmax=50.0, shading='flat')
+        figure.colorbar(mesh, ax=ax, label='Mean Percent Difference')
+    ax.set_yscale('log')
+    ax.invert_yaxis()
+    ax.set_xlabel('Month')
+    ax.set_ylabel('Pressure (hPa)')
+    ax.set_title(summary.dataset)
+    figure.savefig(panel['output'], format='png', bbox_inches='tight')
+
+
+def plot_latitude_bands(panel):
+
+    # Monthly median and interquartile range of the tropospheric column percent differences, one panel per latitude band
+    summary = SummaryStatistics.load(panel['summary'])
+    figure = get_figure((16, 20), 100)
+    axes = figure.subplots(nrows=len(LATITUDE_BANDS), sharex=True)
+
+    # A dataset without colocations has no months, its bands are left empty
+    if len(summary.months):
+        statistics = summary.variables['difference_troposphere_percent']
+        median, lower, upper = statistics.percentile(50), statistics.percentile(25), statistics.percentile(75)
+        months = summary.months.astype('datetime64[D]')
+        for band, ax in enumerate(axes[::-1]):
+            ax.plot(months, median[:, band, 0])
+            ax.fill_between(months, lower[:, band, 0], upper[:, band, 0], alpha=0.3)
+    for band, ax in enumerate(axes[::-1]):
+        ax.set_ylabel(LATITUDE_BANDS[band])
+    axes[0].set_title(f'{summary.dataset} Percent Difference HEGIFTOM Column Definition')
+    axes[-1].set_xlabel('Month')
+    figure.savefig(panel['output'], format='png', bbox_inches='tight')
+
+
+def plot_station(panel):
+
+    # Tropospheric column percent differences of one sonde station against time
+    figure = get_figure((12, 6), 100)
+    ax = figure.subplots()
+    plot_series(ax, *read_series(panel['inputs'], 'difference_troposphere_percent', panel['station']), panel['max_points'])
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Percent Difference HEGIFTOM Column')
+    ax.set_title(f"{panel['dataset']} station {panel['station']}")
+    figure.savefig(panel['output'], format='png', bbox_inches='tight')
+
+
+PANELS = {'column_comparison': plot_column_comparison,
+          'column_statistics': plot_column_statistics,
+          'curtain': plot_curtain,
+          'latitude_bands': plot_latitude_bands,
+          'station': plot_station}
+
+
+def standard_panels(results, summaries, output, max_points=5000):
+
+    # The standard figure set, for results (dataset: results directories) and summaries (dataset: summary file)
+    output = Path(output)
+    panels = [{'kind': 'column_comparison', 'output': output / 'Sonde_Satellite_Ozone_Column_Comparison.png',
+               'inputs': [path for paths in results.values() for path in paths], 'results': results,
+               'max_points': max_points},
+              {'kind': 'column_statistics', 'output': output / 'Sonde_Satellite_Ozone_Column_Statistics.png',
+               'inputs': list(summaries.values()), 'summaries': summaries}]
+    for dataset, path in summaries.items():
+        panels.append({'kind': 'curtain', 'output': output / f'{dataset}_Profile_Difference_Curtain.png',
+                       'inputs': [path], 'summary': path})
+        panels.append({'kind': 'latitude_bands', 'output': output / f'{dataset}_Latitude_Band_Column_Comparison.png',
+                       'inputs': [path], 'summary': path})
+    for dataset, paths in results.items():
+        stations = np.unique(np.concatenate([np.asarray(ColocationResults(path)['station']) for path in paths]))
+        for station in stations:
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', str(station))
+            panels.append({'kind': 'station', 'output': output / 'stations' / f'{dataset}_{name}.png',
+                           'inputs': paths, 'dataset': dataset, 'station': str(station), 'max_points': max_points})
+    return panels
+
+
+def render_panel(panel):
+
+    # Draw and save one panel, returning the time it took
+    start = time.perf_counter()
+    Path(panel['output']).parent.mkdir(parents=True, exist_ok=True)
+    PANELS[panel['kind']](panel)
+    return time.perf_counter() - start
+
+
+def render_panels(panels, workers=1):
+
+    # Render the panels, in worker processes when workers > 1. Returns the render time of each panel.
+    if workers > 1 and len(panels) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_style) as pool:
+            return list(pool.map(render_panel, panels, chunksize=max(1, len(panels) // (4 * workers))))
+    set_style()
+    return [render_panel(panel) for panel in panels]
@@ -0,0 +1,75 @@
+from pathlib import Path
+
+'''
+Registry of the satellite L2 ozone products that can be colocated.
+
+Each product declares where its daily files are found relative to the --input directory, the names of the variables
+holding each field in those files, its number of levels, the units of its ozone values and the reader (see
+readers.READERS) that turns a file into Soundings. Supporting a new product, or a new release of an existing one, is a
+matter of registering another Product. This module only uses the standard library, so the command line can list the
+products without importing the readers.
+'''
+
+
+class Product:
+
+    '''
+    Description of one satellite product.
+
+    pattern is the path of a daily file relative to the input directory, formatted with the day as date (e.g.
+    '{date:%Y}/{date:%m}/product_{date:%Y%m%d}.nc'). variables maps the Soundings fields (quality, date, hour,
+    latitude, longitude, pressure, ozone, ozone_apriori, averaging_kernel) to the product's variable names.
+    ozone_units is one of the colocate --ozone-units choices, and fill_value marks unused pressure levels. grid_size is
+    the spacing in degrees of the product's sounding grid, used as the cell size of the station footprints of the
+    station mode (see colocation.StationFootprints).
+    '''
+
+    def __init__(self, name, pattern, variables, levels, ozone_units, reader='lite', fill_value=-999.0, grid_size=1.0):
+
+        self.name = name
+        self.pattern = pattern
+        self.variables = variables
+        self.levels = levels
+        self.ozone_units = ozone_units
+        self.reader = reader
+        self.fill_value = fill_value
+        self.grid_size = grid_size
+
+    def path(self, root, day):
+
+        # Location of the daily file of day under root
+        return Path(root).expanduser() / self.pattern.format(date=day)
+
+
+PRODUCTS = {}
+
+
+def register_product(product):
+    PRODUCTS[product.name.lower()] = product
+    return product
+
+
+def get_product(name):
+    try:
+        return PRODUCTS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown satellite product {name}, available products: {', '.join(product_names())}")
+
+
+def product_names():
+    return [product.name for product in PRODUCTS.values()]
+
+
+# Variable names of the TROPESS L2 Lite products
+TROPESS_LITE_VARIABLES = {'quality': 'Quality', 'date': 'YYYYMMDD', 'hour': 'UT_Hour', 'latitude': 'Latitude',
+                          'longitude': 'Longitude', 'pressure': 'Pressure', 'ozone': 'Species',
+                          'ozone_apriori': 'ConstraintVector', 'averaging_kernel': 'AveragingKernel'}
+
+# TROPESS release 1.17 Lite products, relative to the product archive (e.g. /tb/CrIS/results/CRIS/Release_1.17.0/
+# Global_Survey_Grid_0.8_RS for CrIS and /tb/AIRSOMI/Release_1.17.0/Global_Survey_Grid_0.7 for AIRS-OMI)
+register_product(Product('TROPESS-CRIS',
+                         'Products/{date:%Y}/{date:%m}/{date:%d}/batch-01/L2_Products_Lite/CRIS_L2-O3-0_{date:%Y}_{date:%m}_{date:%d}_F01_1.17_Litev01_Day_Night.nc',
+                         TROPESS_LITE_VARIABLES, 26, 'None', grid_size=0.8))
+register_product(Product('TROPESS-AIRSOMI',
+                         'Products/{date:%Y}/{date:%m}/{date:%d}/L2_Products_Lite/AIRS_OMI_ATrain_L2-O3_{date:%Y}_{date:%m}_{date:%d}_F01_1.17_Litev01.nc',
+                         TROPESS_LITE_VARIABLES, 26, 'None', grid_size=0.7))
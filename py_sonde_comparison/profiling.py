@@ -0,0 +1,103 @@
+import csv
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+'''
+Lightweight stage profiling for the command line tools.
+
+A Profiler records the wall time and the peak resident memory of named stages, and named counters (soundings read,
+candidate pairs, rejections by reason, ...). Recording is a couple of clock and getrusage calls per stage, so it is
+always on; --profile only decides whether the report is written. Reports from worker processes are merged into the
+parent's profiler.
+'''
+
+
+def peak_rss_mb():
+
+    # Peak resident set size of this process and its finished children, in MB
+    if resource is None:
+        return float('nan')
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return max(own, children) / (1024.0 * 1024.0)
+    # On Linux ru_maxrss carries over the peak of the parent process it was forked from, the high water mark of
+    # /proc/self/status only covers this process
+    try:
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration, ValueError):
+        pass
+    return max(own, children) / 1024.0
+
+
+class Profiler:
+
+    '''
+    Per stage wall time (seconds, summed over repeats), number of calls and peak RSS (MB), plus named counters.
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start, 1, peak_rss_mb())
+
+    def add_stage(self, name, seconds, calls, peak_rss):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_rss_mb': 0.0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak_rss)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def report(self):
+        return {'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'counts': dict(self.counts),
+                'wall_seconds': time.perf_counter() - self.start,
+                'peak_rss_mb': peak_rss_mb()}
+
+    def merge(self, report):
+
+        # Add the stages and counts of another profiler's report (e.g. from a worker process)
+        for name, stage in report['stages'].items():
+            self.add_stage(name, stage['seconds'], stage['calls'], stage['peak_rss_mb'])
+        for name, n in report['counts'].items():
+            self.count(name, n)
+
+    def write(self, path, command=None):
+
+        # Write the report as JSON, or as CSV (one row per stage and per counter) if path ends in .csv
+        report = self.report()
+        if command is not None:
+            report['command'] = command
+        path = Path(path)
+        if path.suffix.lower() == '.csv':
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['kind', 'name', 'seconds', 'calls', 'peak_rss_mb', 'value'])
+                for name, stage in report['stages'].items():
+                    writer.writerow(['stage', name, f"{stage['seconds']:.6f}", stage['calls'], f"{stage['peak_rss_mb']:.1f}", ''])
+                for name, n in report['counts'].items():
+                    writer.writerow(['count', name, '', '', '', n])
+                writer.writerow(['total', command or '', f"{report['wall_seconds']:.6f}", '', f"{report['peak_rss_mb']:.1f}", ''])
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
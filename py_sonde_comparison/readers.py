@@ -0,0 +1,173 @@
+from pathlib import Path
+import numpy as np
+import xarray as xr
+
+'''
+Readers for satellite L2 ozone products.
+
+Each reader turns one daily product file into Soundings, holding the quality-filtered soundings as contiguous typed
+arrays, and can deliver a file in chunks of soundings. Which reader, file pattern and variable names a product uses is
+declared in the products registry. Profiles are stored on the product's full level grid, right-aligned so that the
+valid levels of a sounding always occupy its last n_levels entries, with the unused leading levels filled with NaN.
+'''
+
+
+class Soundings:
+
+    '''
+    Columnar container of satellite soundings.
+
+    date is datetime64[D], hour is UT hour as float64, latitude/longitude keep the product dtype. pressure, ozone and
+    ozone_apriori are (n, levels) arrays and averaging_kernel is (n, levels, levels), right-aligned on n_levels.
+    '''
+
+    def __init__(self, date, hour, latitude, longitude, pressure, ozone, ozone_apriori, averaging_kernel, n_levels):
+
+        self.date = date
+        self.hour = hour
+        self.latitude = latitude
+        self.longitude = longitude
+        self.pressure = pressure
+        self.ozone = ozone
+        self.ozone_apriori = ozone_apriori
+        self.averaging_kernel = averaging_kernel
+        self.n_levels = n_levels
+
+    def __len__(self):
+        return len(self.date)
+
+    @property
+    def levels(self):
+        return self.pressure.shape[1]
+
+    def subset(self, indices):
+
+        # New Soundings holding only the selected soundings
+        return Soundings(self.date[indices], self.hour[indices], self.latitude[indices], self.longitude[indices],
+                         self.pressure[indices], self.ozone[indices], self.ozone_apriori[indices],
+                         self.averaging_kernel[indices], self.n_levels[indices])
+
+    @staticmethod
+    def concatenate(days):
+
+        # Join several (per day) Soundings into one contiguous dataset
+        days = [day for day in days if day is not None]
+        if not days:
+            return empty_soundings()
+        return Soundings(*[np.concatenate([getattr(day, name) for day in days]) for name in
+                           ('date', 'hour', 'latitude', 'longitude', 'pressure', 'ozone', 'ozone_apriori',
+                            'averaging_kernel', 'n_levels')])
+
+
+def empty_soundings(levels=26):
+
+    # Soundings dataset with no entries
+    return Soundings(np.empty(0, dtype='datetime64[D]'), np.empty(0), np.empty(0), np.empty(0),
+                     np.empty((0, levels)), np.empty((0, levels)), np.empty((0, levels)),
+                     np.empty((0, levels, levels)), np.empty(0, dtype=np.int64))
+
+
+def decode_yyyymmdd(values):
+
+    # Convert YYYYMMDD numbers (as stored in TROPESS products) into datetime64[D], in one vectorized operation
+    values = np.asarray(values).astype(np.int64)
+    years = values // 10000
+    months = (values // 100) % 100
+    days = values % 100
+    return ((years - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (months - 1).astype('timedelta64[M]')
+            ).astype('datetime64[D]') + (days - 1).astype('timedelta64[D]')
+
+
+def right_align_levels(valid, *profiles):
+
+    # Move the valid levels of each row to the end of the row (keeping their order), and fill the remainder with NaN.
+    # Returns the number of valid levels per row, followed by the aligned profiles.
+    n_levels = valid.sum(axis=1)
+    order = np.argsort(valid, axis=1, kind='stable')
+    pad = np.arange(valid.shape[1])[np.newaxis, :] < (valid.shape[1] - n_levels)[:, np.newaxis]
+    aligned = []
+    for profile in profiles:
+        profile = np.take_along_axis(np.asarray(profile, dtype=float), order, axis=1)
+        profile[pad] = np.nan
+        aligned.append(profile)
+    return (n_levels, *aligned)
+
+
+def read_lite(path, product, select=None, chunk_size=None):
+
+    # Read one daily L2 Lite style file (one sounding dimension, levels on the second dimension) into Soundings, using
+    # the product's variable names. Only soundings passing the quality flag are kept, in chunks read from chunk_size
+    # consecutive soundings of the file (all at once by default), each chunk being yielded as its own Soundings.
+    # Raises FileNotFoundError if the file is not available.
+    # select is an optional callable (date, hour, latitude, longitude) -> boolean mask; when given only the
+    # geolocation variables are read for every sounding, and the profile, a priori and averaging kernel variables
+    # are read (lazily, from disk) only for the selected rows.
+    variables = product.variables
+    try:
+        general = xr.open_dataset(Path(path).as_posix(), engine="h5netcdf")
+    except Exception as e:
+        raise FileNotFoundError(f"{path} not available: {e}")
+
+    with general:
+        levels = general[variables['pressure']].shape[1]
+        if levels != product.levels:
+            raise ValueError(f"{path} has {levels} levels, {product.name} products have {product.levels}")
+
+        names = [variables[field] for field in ('date', 'hour', 'latitude', 'longitude', 'pressure', 'ozone',
+                                                 'ozone_apriori', 'averaging_kernel')]
+        dimension = general[variables['quality']].dims[0]
+        quality = general[variables['quality']].values > 0
+        if select is None:
+            # Reading whole variables (or slices of them) and dropping the bad soundings in memory is much faster than
+            # reading the good rows by index, which goes through h5py fancy indexing
+            chunk_size = chunk_size or max(len(quality), 1)
+            chunks = [(slice(start, start + chunk_size), quality[start:start + chunk_size])
+                      for start in range(0, max(len(quality), 1), chunk_size)]
+        else:
+            rows = np.nonzero(quality)[0]
+            sounding = {dimension: rows}
+            keep = select(decode_yyyymmdd(general[variables['date']].isel(sounding).values),
+                          general[variables['hour']].isel(sounding).values.astype(np.float64),
+                          general[variables['latitude']].isel(sounding).values,
+                          general[variables['longitude']].isel(sounding).values)
+            rows = rows[np.asarray(keep, dtype=bool)]
+            chunk_size = chunk_size or max(len(rows), 1)
+            chunks = [(rows[start:start + chunk_size], slice(None)) for start in range(0, max(len(rows), 1), chunk_size)]
+
+        for indexer, mask in chunks:
+            chunk = general[names].isel({dimension: indexer}).load()
+            good = {name: chunk[name].values[mask] for name in names}
+
+            pressure = good[variables['pressure']]
+            n_levels, pressure, ozone, ozone_apriori = right_align_levels(pressure > product.fill_value, pressure,
+                                                                          good[variables['ozone']],
+                                                                          good[variables['ozone_apriori']])
+
+            yield Soundings(decode_yyyymmdd(good[variables['date']]),
+                            good[variables['hour']].astype(np.float64),
+                            good[variables['latitude']],
+                            good[variables['longitude']],
+                            pressure,
+                            ozone,
+                            ozone_apriori,
+                            good[variables['averaging_kernel']].astype(float),
+                            n_levels)
+
+
+# Reader of each file layout, by the name products refer to it with. A reader is called with the path of a daily file,
+# the Product, an optional select callable and a chunk size, and yields the file's soundings as Soundings chunks.
+READERS = {'lite': read_lite}
+
+
+def register_reader(name, reader):
+    READERS[name] = reader
+    return reader
+
+
+def read_day(path, product, day, select=None, chunk_size=None):
+
+    # Soundings of one day of a product under the input directory path, or None if the day is not available
+    try:
+        return Soundings.concatenate(list(READERS[product.reader](product.path(path, day), product, select, chunk_size)))
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,120 @@
+import shutil
+from pathlib import Path
+import numpy as np
+
+from .comparison import PRESSURE_GRID
+
+'''
+Typed, memory-mappable colocation results.
+
+The colocations of a date range are stored as a directory holding one uncompressed .npy file per variable, all with
+one row per colocation, plus the pressure grid of the profile differences. Every variable has a fixed dtype (float64
+profiles on the pressure grid, datetime64[s] launch times, fixed width station IDs), so nothing is pickled and the
+files can be memory-mapped: ColocationResults opens them lazily and selects rows by launch time or latitude band,
+reading only the selected rows of the variables asked for.
+'''
+
+# Variables of a results directory, with their dtype and whether they hold a profile on the pressure grid
+RESULT_VARIABLES = {'difference_profile_percent': ('float64', True),
+                    'difference_profile_absolute': ('float64', True),
+                    'difference_troposphere_percent': ('float64', False),
+                    'difference_troposphere_absolute': ('float64', False),
+                    'latitude_colocation': ('float64', False),
+                    'longitude_colocation': ('float64', False),
+                    'station': ('U16', False),
+                    'time_vector': ('datetime64[s]', False)}
+
+
+def records_to_arrays(records):
+
+    # Typed arrays of the colocation records of colocate_soundings, in record order
+    columns = {'difference_profile_percent': 2, 'difference_profile_absolute': 3, 'difference_troposphere_percent': 4,
+               'difference_troposphere_absolute': 5, 'latitude_colocation': 6, 'longitude_colocation': 7,
+               'station': 8, 'time_vector': 9}
+    arrays = {}
+    for name, (dtype, profile) in RESULT_VARIABLES.items():
+        values = np.asarray([record[columns[name]] for record in records], dtype=dtype)
+        arrays[name] = values.reshape(len(records), len(PRESSURE_GRID)) if profile else values
+    return arrays
+
+
+def write_results(path, arrays, pressure_grid=PRESSURE_GRID):
+
+    # Write a results directory, through a temporary directory so a partial directory is never left behind
+    write_results_parts(path, [arrays], len(arrays['time_vector']), pressure_grid)
+
+
+def write_results_parts(path, parts, rows, pressure_grid=PRESSURE_GRID):
+
+    # Write a results directory of rows colocations given as an iterable of array dicts (e.g. one per day), each part
+    # being copied into the preallocated .npy files in turn, so the whole date range is never held in memory at once
+    path = Path(path)
+    partial = path.with_name(path.name + '.part')
+    if partial.exists():
+        shutil.rmtree(partial)
+    partial.mkdir(parents=True)
+    np.save(partial / 'pressure_grid.npy', np.asarray(pressure_grid, dtype=float))
+    columns = {name: np.lib.format.open_memmap(partial / f'{name}.npy', mode='w+', dtype=dtype,
+                                               shape=(rows, len(pressure_grid)) if profile else (rows,))
+               for name, (dtype, profile) in RESULT_VARIABLES.items()}
+    start = 0
+    for part in parts:
+        end = start + len(part['time_vector'])
+        if end > rows:
+            raise ValueError(f"More than the expected {rows} colocations written to {path}")
+        for name, (dtype, _) in RESULT_VARIABLES.items():
+            columns[name][start:end] = np.asarray(part[name], dtype=dtype)
+        start = end
+    if start != rows:
+        raise ValueError(f"{start} colocations written to {path}, {rows} expected")
+    for column in columns.values():
+        column.flush()
+    del columns
+    if path.exists():
+        shutil.rmtree(path)
+    partial.rename(path)
+
+
+class ColocationResults:
+
+    '''
+    Read access to a results directory. Variables are memory-mapped on first use, select returns the rows in a time
+    range and/or latitude band, and read copies only the selected rows of the requested variables into memory.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.pressure_grid = np.load(self.path / 'pressure_grid.npy')
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self['time_vector'])
+
+    def __getitem__(self, name):
+        if name not in RESULT_VARIABLES:
+            raise KeyError(name)
+        if name not in self.arrays:
+            self.arrays[name] = np.load(self.path / f'{name}.npy', mmap_mode='r')
+        return self.arrays[name]
+
+    def select(self, start=None, end=None, latitude_band=None, station=None):
+
+        # Indices of the colocations launched in [start, end), with a latitude in [south, north) for a latitude_band
+        # of (south, north) and from the given sonde station. Only the variables used for selecting are read.
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self['time_vector'] >= np.datetime64(start, 's')
+        if end is not None:
+            mask &= self['time_vector'] < np.datetime64(end, 's')
+        if latitude_band is not None:
+            latitude = self['latitude_colocation']
+            mask &= (latitude >= latitude_band[0]) & (latitude < latitude_band[1])
+        if station is not None:
+            mask &= self['station'] == station
+        return np.nonzero(mask)[0]
+
+    def read(self, names=None, start=None, end=None, latitude_band=None):
+
+        # Selected rows of the requested variables (all variables by default) as in-memory arrays
+        indices = self.select(start, end, latitude_band)
+        return {name: np.asarray(self[name][indices]) for name in (names or RESULT_VARIABLES)}
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import re
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .results import records_to_arrays
+
+'''
+Per day checkpoint shards of colocation results.
+
+colocate stores the colocations of every finished day as its own .npz shard, next to a manifest listing the finished
+days. Shards are kept per dataset and per set of colocation criteria, so a rerun (after an interruption, or over an
+overlapping or extended date range) only colocates the days that are not in the manifest yet, and the output for any
+date range is assembled from the shards, one day at a time. Several processes, also on different nodes sharing the
+output directory (see batch.py), can save days of the same shards at once: manifest updates are serialised by a lock
+file.
+'''
+
+
+class ColocationShards:
+
+    '''
+    Colocation results of one dataset and set of colocation criteria, one .npz shard per day under
+    {output}/{dataset}_shards/{criteria}/YYYY/YYYYMMDD.npz, with a manifest.json holding the criteria and the number of
+    colocations of every finished day. Shards and the manifest are written through temporary files, so an interrupted
+    run leaves every finished day behind intact.
+    '''
+
+    def __init__(self, output, dataset, gaw_locations, ozone_units, distance_location, distance_time):
+
+        self.parameters = {'dataset': dataset, 'gaw_locations': gaw_locations, 'ozone_units': ozone_units,
+                           'distance_location': distance_location, 'distance_time': distance_time}
+        # Long station lists are named by a hash, the full list is kept in the manifest
+        stations = gaw_locations if len(gaw_locations) <= 32 else 'stations_' + hashlib.sha1(gaw_locations.encode()).hexdigest()[:12]
+        key = re.sub(r'[^A-Za-z0-9_.-]', '_', f'{stations}_{ozone_units}_{distance_location:g}km_{distance_time:g}h')
+        self.root = Path(output) / f'{dataset}_shards' / key
+        self.manifest_path = self.root / 'manifest.json'
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {'parameters': self.parameters, 'days': {}}
+
+    @contextmanager
+    def locked(self):
+
+        # Exclusive lock of the manifest against other processes, POSIX record locks also hold on NFS. Without fcntl
+        # (Windows) there is no lock, and only one process may save at a time.
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / 'manifest.lock', 'a') as f:
+            if fcntl is not None:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def path(self, day):
+        return self.root / f'{day.year:04}' / f'{day.year:04}{day.month:02}{day.day:02}.npz'
+
+    def completed(self, day):
+        return day.strftime('%Y-%m-%d') in self.manifest['days'] and self.path(day).exists()
+
+    def save(self, day, records):
+
+        # Store the colocation records of one day, then add the day to the manifest
+        path = self.path(day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + '.part')
+        with open(partial, 'wb') as f:
+            np.savez(f, **records_to_arrays(records))
+        partial.replace(path)
+
+        # The manifest is read again under the lock, so days saved meanwhile by other processes are kept
+        with self.locked():
+            self.manifest = self.read_manifest()
+            self.manifest['days'][day.strftime('%Y-%m-%d')] = {'colocations': len(records)}
+            self.manifest['days'] = dict(sorted(self.manifest['days'].items()))
+            partial = self.manifest_path.with_name(self.manifest_path.name + '.part')
+            with open(partial, 'w') as f:
+                json.dump(self.manifest, f, indent=2)
+            partial.replace(self.manifest_path)
+
+    def count(self, days):
+
+        # Number of colocations of the given days, from the manifest
+        return sum(self.manifest['days'][day.strftime('%Y-%m-%d')]['colocations'] for day in days if self.completed(day))
+
+    def iter_load(self, days):
+
+        # Colocations of each of the given days with a shard, in day order, one day in memory at a time
+        for day in days:
+            if self.completed(day):
+                with np.load(self.path(day)) as npzfile:
+                    yield {name: npzfile[name] for name in npzfile.files}
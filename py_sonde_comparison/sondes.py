@@ -0,0 +1,344 @@
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from .logger import logger
+
+'''
+WOUDC ozonesonde access, parsing and local caching.
+
+Each sonde is parsed once, when it is fetched, into a Sondes dataset, holding the launch time, location and station
+of each sonde as arrays, and the parsed (ascending) pressure and ozone (ppb) profiles stored back to back, with
+offsets marking where each sonde starts. Parsed sondes can be cached on disk, one .npz file per query key (station or 'all') and day, so that
+repeated runs only request the days that have not been fetched before. Sondes are requested either for all stations,
+or station by station for a list of GAW IDs (given on the command line or in a station file).
+'''
+
+
+class Sondes:
+
+    '''
+    Columnar container of parsed ozonesondes.
+
+    launch is datetime64[s], latitude/longitude are float64 and station holds the GAW ID of each sonde. pressure (hPa)
+    and ozone (ppb) hold every profile back to back, profile i being pressure[offsets[i]:offsets[i+1]].
+    '''
+
+    def __init__(self, station, launch, latitude, longitude, pressure, ozone, offsets):
+
+        self.station = station
+        self.launch = launch
+        self.latitude = latitude
+        self.longitude = longitude
+        self.pressure = pressure
+        self.ozone = ozone
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.launch)
+
+    @property
+    def date(self):
+        return self.launch.astype('datetime64[D]')
+
+    @property
+    def hour(self):
+        # UT launch hour, truncated to the hour as used by the colocation time criteria
+        return ((self.launch - self.date) // np.timedelta64(1, 'h')).astype(float)
+
+    def launch_datetime(self, i):
+        return self.launch[i].astype(datetime)
+
+    def locations(self):
+
+        # Launch day, UT hour, latitude and longitude of each sonde, as used by colocation.candidate_mask
+        return self.date, self.hour, self.latitude, self.longitude
+
+    def profile(self, i):
+
+        # Pressure and ozone profile of sonde i
+        return self.pressure[self.offsets[i]:self.offsets[i+1]], self.ozone[self.offsets[i]:self.offsets[i+1]]
+
+    def subset(self, indices):
+
+        # New Sondes holding only the selected sondes
+        indices = np.arange(len(self))[indices]
+        profiles = [self.profile(i) for i in indices]
+        return Sondes.from_profiles(self.station[indices], self.launch[indices], self.latitude[indices],
+                                    self.longitude[indices], profiles)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, station=self.station, launch=self.launch, latitude=self.latitude, longitude=self.longitude,
+                     pressure=self.pressure, ozone=self.ozone, offsets=self.offsets)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as npzfile:
+            return Sondes(npzfile['station'], npzfile['launch'], npzfile['latitude'], npzfile['longitude'],
+                          npzfile['pressure'], npzfile['ozone'], npzfile['offsets'])
+
+    @staticmethod
+    def from_profiles(station, launch, latitude, longitude, profiles):
+
+        # Build a Sondes dataset from per sonde (pressure, ozone) profiles
+        lengths = np.asarray([len(pressure) for pressure, _ in profiles], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        pressure = np.concatenate([pressure for pressure, _ in profiles]) if profiles else np.empty(0)
+        ozone = np.concatenate([ozone for _, ozone in profiles]) if profiles else np.empty(0)
+        return Sondes(np.asarray(station, dtype=str), np.asarray(launch, dtype='datetime64[s]'),
+                      np.asarray(latitude, dtype=float), np.asarray(longitude, dtype=float),
+                      np.asarray(pressure, dtype=float), np.asarray(ozone, dtype=float), offsets)
+
+    @staticmethod
+    def concatenate(parts):
+
+        # Join several (per day) Sondes into one dataset
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            return Sondes.from_profiles([], [], [], [], [])
+        offsets = [parts[0].offsets[:1]]
+        end = offsets[0][-1]
+        for part in parts:
+            # Empty parts add no offsets, the end of the profiles so far is kept apart
+            offsets.append(part.offsets[1:] - part.offsets[0] + end)
+            end += part.offsets[-1] - part.offsets[0]
+        return Sondes(np.concatenate([part.station for part in parts]), np.concatenate([part.launch for part in parts]),
+                      np.concatenate([part.latitude for part in parts]), np.concatenate([part.longitude for part in parts]),
+                      np.concatenate([part.pressure for part in parts]), np.concatenate([part.ozone for part in parts]),
+                      np.concatenate(offsets))
+
+
+def station_id(feature):
+
+    # GAW ID of the station a WOUDC feature was launched from
+    properties = feature['properties']
+    return str(properties.get('gaw_id') or properties.get('platform_id') or '')
+
+
+def parse_data_block(data_block):
+
+    # Parse the data_block of a WOUDC ozonesonde feature into pressure (hPa, ascending) and ozone (ppb) profiles.
+    # The pressure and ozone partial pressure columns are read in bulk, missing or unreadable values, including those
+    # of rows too short to hold them, become NaN and the rows holding them are skipped. Returns None if fewer than two
+    # valid levels could be read.
+    header_end = data_block.find('\r\n')
+    header = data_block[:header_end].split(",")
+
+    # Some sonde locations have different data formats
+    if header[0] == 'Duration':
+        startPoint = 1
+    else:
+        startPoint = 0
+
+    # The header and anything after the last line break are not data
+    data_end = data_block.rfind('\r\n')
+    if header_end < 0 or data_end <= header_end:
+        return None
+    # Rows are only split as far as the two columns read, so rows narrower or wider than the header are read too
+    lines = pd.Series(data_block[header_end+2:data_end].split('\r\n'))
+    table = lines.str.split(',',n=startPoint+2,expand=True).reindex(columns=range(startPoint+2))
+    sonde_pressure_mid = pd.to_numeric(table[startPoint],errors='coerce').to_numpy(dtype=float)
+    sonde_vmr_mid = pd.to_numeric(table[startPoint+1],errors='coerce').to_numpy(dtype=float)
+
+    # Check if too many values are missing in the ozonesonde dataset, reading stops at the fifth missing level
+    missing = np.isnan(sonde_pressure_mid) | np.isnan(sonde_vmr_mid)
+    missing_rows = np.nonzero(missing)[0]
+    if len(missing_rows) >= 5:
+        logger.info("Ozonesonde missing too many values, skipping....")
+        sonde_pressure_mid = sonde_pressure_mid[:missing_rows[4]]
+        sonde_vmr_mid = sonde_vmr_mid[:missing_rows[4]]
+        missing = missing[:missing_rows[4]]
+    sonde_pressure_mid = sonde_pressure_mid[~missing]
+    sonde_vmr_mid = sonde_vmr_mid[~missing]
+
+    if len(sonde_pressure_mid) < 2:
+        return None
+
+    # select valid sonde levels and check pressure is correct way around
+    if sonde_pressure_mid[0] > sonde_pressure_mid[1]:
+        sonde_pressure_mid = np.flip(sonde_pressure_mid)
+        sonde_vmr_mid = np.flip(sonde_vmr_mid)
+    indpp_2 = np.where(sonde_pressure_mid > 0)[0]
+
+    sonde_vmr = (sonde_vmr_mid[indpp_2]/(sonde_pressure_mid[indpp_2]*100000))*1e9
+
+    return sonde_pressure_mid[indpp_2], sonde_vmr
+
+
+def parse_features(features):
+
+    # Parse WOUDC features into a Sondes dataset, sondes whose profile cannot be read are left out
+    station, launch, latitude, longitude, profiles = [], [], [], [], []
+    for feature in features:
+        try:
+            profile = parse_data_block(feature['properties']['data_block'])
+        except Exception as e:
+            logger.debug(f"Ozonesonde {station_id(feature)} {feature['properties']['instance_datetime']} could not be parsed: {e}")
+            profile = None
+        if profile is None:
+            logger.info(f"Ozonesonde {station_id(feature)} {feature['properties']['instance_datetime']} has no usable profile, skipping....")
+            continue
+        station.append(station_id(feature))
+        launch.append(datetime.strptime(feature['properties']['instance_datetime'], '%Y/%m/%d %H:%M:%S+00'))
+        latitude.append(feature['geometry']['coordinates'][1])
+        longitude.append(feature['geometry']['coordinates'][0])
+        profiles.append(profile)
+    return Sondes.from_profiles(station, launch, latitude, longitude, profiles)
+
+
+def read_station_file(path):
+
+    # GAW IDs listed in a station file, one station per line (the first comma or whitespace separated column, so a
+    # station catalogue with the GAW ID in its first column can be used as is). Blank lines and lines starting with #
+    # are ignored.
+    stations = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                stations.append(re.split(r'[,\s]+', line)[0])
+    return stations
+
+
+def station_list(gaw_locations):
+
+    # Stations of a --gaw-locations value: 'all', a comma separated list of GAW IDs or the path of a station file.
+    # Returns 'all', or the GAW IDs in the order given, without duplicates, joined by commas.
+    if str(gaw_locations).lower() == 'all':
+        return 'all'
+    if Path(gaw_locations).expanduser().is_file():
+        stations = read_station_file(Path(gaw_locations).expanduser())
+    else:
+        stations = [station.strip() for station in str(gaw_locations).split(',') if station.strip()]
+    if not stations:
+        raise ValueError(f"No GAW IDs found in {gaw_locations}")
+    return ','.join(dict.fromkeys(stations))
+
+
+def fetch_woudc(begin,end,gaw_locations,client=None):
+
+    # Function based on pywoudc information, grabs ozonesonde features for the supplied daterange.
+    # Any object with the pywoudc get_data interface can be given as client, e.g. a local stand in for WOUDC.
+    if client is None:
+        from pywoudc import WoudcClient
+
+        # Invoke pyWoudc
+        client = WoudcClient()
+
+    # Grab ozonesonde data, either all available data, or from a specific site
+    if gaw_locations=='all':
+        data = client.get_data('ozonesonde',
+                                temporal=[begin, end])
+    else:
+        data = client.get_data('ozonesonde',
+                            filters={'gaw_id': gaw_locations},
+                            temporal=[begin, end])
+
+    # Routine to check if any sonde data has been found by input specifications, if not
+    # program exits.
+    try:
+        return data['features']
+    except Exception as e:
+        logger.error(f"No Sonde data available, or incorrect sonde site input, exiting.....{e}")
+        sys.exit(1)
+
+
+class SondeCache:
+
+    '''
+    On-disk cache of parsed sondes, one Sondes .npz file per query key and day. A day file exists once that day has
+    been fetched, even if no sondes were launched, so cached days are never requested again. Sondes cached for 'all'
+    stations also serve queries for a single station.
+    '''
+
+    def __init__(self, root):
+        self.root = Path(root).expanduser()
+
+    def path(self, key, day):
+        key = re.sub(r'[^A-Za-z0-9_.-]', '_', str(key))
+        return self.root / key / f'{day.year:04}' / f'{day.year:04}{day.month:02}{day.day:02}.npz'
+
+    def keys(self, gaw_locations):
+        return ['all'] if gaw_locations == 'all' else [gaw_locations, 'all']
+
+    def load(self, day, gaw_locations):
+
+        # Cached sondes for a day, or None if the day has not been fetched
+        for key in self.keys(gaw_locations):
+            path = self.path(key, day)
+            if path.exists():
+                sondes = Sondes.load(path)
+                if key != gaw_locations:
+                    sondes = sondes.subset(np.isin(sondes.station, str(gaw_locations).split(',')))
+                return sondes
+        return None
+
+    def save(self, day, gaw_locations, sondes):
+        path = self.path(gaw_locations, day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write through a temporary file, so an interrupted run never leaves a partial day behind
+        partial = path.with_name(path.name + '.part')
+        sondes.save(partial)
+        partial.replace(path)
+
+
+def contiguous_runs(days):
+
+    # Split a sorted list of days into runs of consecutive days
+    runs = []
+    for day in days:
+        if runs and day - runs[-1][-1] == timedelta(days=1):
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    return runs
+
+
+def grab_station(days,gaw_locations,sonde_cache=None,offline=False,client=None):
+
+    # Parsed sondes of one query key ('all' or a single GAW ID) for each of the given days, as a dict by day. Only days
+    # that are not cached are requested from WOUDC, one request per run of consecutive missing days.
+    by_day = {}
+    if sonde_cache is not None:
+        for day in days:
+            by_day[day] = sonde_cache.load(day,gaw_locations)
+    missing = [day for day in days if by_day.get(day) is None]
+
+    if missing and offline:
+        logger.warning(f"{len(missing)} days not found in the sonde cache for {gaw_locations}, offline mode so these days have no sondes")
+    elif missing:
+        for run in contiguous_runs(missing):
+            features = fetch_woudc(run[0],run[-1] + timedelta(days=1),gaw_locations,client)
+            sondes = parse_features(features)
+            for day in run:
+                by_day[day] = sondes.subset(sondes.date == np.datetime64(day.date(),'D'))
+                if sonde_cache is not None:
+                    sonde_cache.save(day,gaw_locations,by_day[day])
+    return by_day
+
+
+def grab_woudc(start_date,end_date,gaw_locations,cache=None,offline=False,client=None):
+
+    # Grabs the parsed ozonesonde profiles launched in [start_date, end_date), as a Sondes dataset ordered by day.
+    # gaw_locations is 'all' or a comma separated list of GAW IDs, each station being requested (and cached) on its
+    # own, and the sondes of a day ordered by launch time. With a cache directory, only days that are not cached yet
+    # are requested from WOUDC, and newly fetched days are added to the cache. Offline, only the cache is used.
+    days = [start_date + timedelta(days=j) for j in range(0,(end_date - start_date).days)]
+    sonde_cache = SondeCache(cache) if cache is not None else None
+
+    if gaw_locations == 'all':
+        by_day = grab_station(days,gaw_locations,sonde_cache,offline,client)
+    else:
+        stations = [grab_station(days,station,sonde_cache,offline,client) for station in gaw_locations.split(',')]
+        by_day = {}
+        for day in days:
+            sondes = Sondes.concatenate([station.get(day) for station in stations])
+            by_day[day] = sondes.subset(np.argsort(sondes.launch,kind='stable'))
+
+    sondes = Sondes.concatenate([by_day.get(day) for day in days])
+    logger.info(f"Number of Sondes in date range {len(sondes)}")
+    return sondes
@@ -0,0 +1,236 @@
+import numpy as np
+
+'''
+Streaming summary statistics of colocation results.
+
+Results are added chunk by chunk to mergeable accumulators, grouped by month, latitude band and pressure level: counts,
+means and sums of squared deviations (Welford/Chan updates, so chunks and whole summaries can be combined in any
+order), minima, maxima and fixed-bin histograms (logarithmic for the absolute differences) from which medians and other
+percentiles are estimated to within a bin width. A summary is a few small arrays per variable, saved as a compressed
+.npz that plotting and reports can read without going back to the results.
+'''
+
+# Latitude band edges (degrees), giving southern and northern polar regions, midlatitudes and subtropics, and the tropics,
+# following the HEGIFTOM band limits
+LATITUDE_BAND_EDGES = np.asarray([-90.0, -60.0, -30.0, -15.0, 15.0, 30.0, 60.0, 90.0])
+LATITUDE_BANDS = ['60S-90S', '30S-60S', '15S-30S', '15S-15N', '15N-30N', '30N-60N', '60N-90N']
+
+
+def symmetric_log_edges(smallest, largest, per_decade):
+
+    # Bin edges growing geometrically from smallest to largest on both sides of zero, with a single bin between
+    # -smallest and smallest, so values spanning many orders of magnitude are binned to the same relative precision
+    positive = np.logspace(np.log10(smallest), np.log10(largest), int(round(np.log10(largest / smallest) * per_decade)) + 1)
+    return np.concatenate([-positive[::-1], positive])
+
+def log_tailed_edges(edges, largest, per_decade):
+
+    # Symmetric linear bin edges extended geometrically out to -largest and largest, so outliers are still binned to
+    # a fixed relative precision instead of all falling in the first and last bins
+    tail = np.logspace(np.log10(edges[-1]), np.log10(largest), int(round(np.log10(largest / edges[-1]) * per_decade)) + 1)[1:]
+    return np.concatenate([-tail[::-1], edges, tail])
+
+
+# Histogram bin edges of each summarised variable, values outside the edges are counted in the first or last bin.
+# Absolute differences are stored as (satellite - sonde) * 1e9 on ppb profiles and their tropospheric columns as
+# column_du of (satellite - sonde) * 1e6, typically 1e5 to 1e13, so they get logarithmic bins (10 and 20 per decade).
+# Percent differences get linear bins within 200% and logarithmic ones beyond, where sondes read little ozone.
+HISTOGRAM_EDGES = {'difference_profile_percent': log_tailed_edges(np.linspace(-200.0, 200.0, 201), 1e4, 10),
+                   'difference_profile_absolute': symmetric_log_edges(1e3, 1e15, 10),
+                   'difference_troposphere_percent': log_tailed_edges(np.linspace(-200.0, 200.0, 401), 1e4, 20),
+                   'difference_troposphere_absolute': symmetric_log_edges(1e0, 1e12, 20)}
+
+
+def latitude_band(latitudes):
+
+    # Index into LATITUDE_BANDS of each latitude
+    return np.digitize(np.asarray(latitudes, dtype=float), LATITUDE_BAND_EDGES[1:-1])
+
+
+class VariableStatistics:
+
+    '''
+    Accumulators of one variable, as arrays of shape (months, bands, levels) (histogram: (months, bands, levels, bins)).
+    '''
+
+    def __init__(self, edges, levels, months=0):
+        self.edges = np.asarray(edges, dtype=float)
+        shape = (months, len(LATITUDE_BANDS), levels)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.minimum = np.full(shape, np.inf)
+        self.maximum = np.full(shape, -np.inf)
+        self.histogram = np.zeros(shape + (len(self.edges) - 1,), dtype=np.int32)
+
+    @property
+    def levels(self):
+        return self.count.shape[2]
+
+    def add_months(self, n):
+
+        # Append n empty months
+        empty = VariableStatistics(self.edges, self.levels, n)
+        for name in ('count', 'mean', 'm2', 'minimum', 'maximum', 'histogram'):
+            setattr(self, name, np.concatenate([getattr(self, name), getattr(empty, name)]))
+
+    def update(self, month, band, values):
+
+        # Add a chunk of values (rows, levels) of one month, with the latitude band of each row. NaNs are ignored.
+        values = np.asarray(values, dtype=float).reshape(len(band), self.levels)
+        groups = np.broadcast_to(band[:, np.newaxis] * self.levels + np.arange(self.levels)[np.newaxis, :], values.shape)
+        valid = np.isfinite(values)
+        groups, values = groups[valid], values[valid]
+        size = len(LATITUDE_BANDS) * self.levels
+
+        count = np.bincount(groups, minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, np.bincount(groups, weights=values, minlength=size) / count, 0.0)
+        m2 = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=size)
+        minimum = np.full(size, np.inf)
+        np.minimum.at(minimum, groups, values)
+        maximum = np.full(size, -np.inf)
+        np.maximum.at(maximum, groups, values)
+        bins = np.clip(np.searchsorted(self.edges, values, side='right') - 1, 0, len(self.edges) - 2)
+        histogram = np.bincount(groups * (len(self.edges) - 1) + bins, minlength=size * (len(self.edges) - 1))
+
+        shape = (len(LATITUDE_BANDS), self.levels)
+        self.count[month], self.mean[month], self.m2[month] = merge_moments(self.count[month], self.mean[month], self.m2[month],
+                                                                            count.reshape(shape), mean.reshape(shape), m2.reshape(shape))
+        self.minimum[month] = np.minimum(self.minimum[month], minimum.reshape(shape))
+        self.maximum[month] = np.maximum(self.maximum[month], maximum.reshape(shape))
+        self.histogram[month] += histogram.reshape(shape + (-1,)).astype(np.int32)
+
+    def total(self, axis):
+
+        # Statistics combined over one or more axes (0: months, 1: bands, 2: levels), keeping them as length 1 axes
+        combined = VariableStatistics(self.edges, self.levels)
+        combined.count = self.count.sum(axis=axis, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            combined.mean = np.where(combined.count > 0, (self.count * self.mean).sum(axis=axis, keepdims=True) / combined.count, 0.0)
+        combined.m2 = (self.m2 + self.count * (self.mean - combined.mean) ** 2).sum(axis=axis, keepdims=True)
+        combined.minimum = self.minimum.min(axis=axis, keepdims=True)
+        combined.maximum = self.maximum.max(axis=axis, keepdims=True)
+        combined.histogram = self.histogram.sum(axis=axis, keepdims=True)
+        return combined
+
+    def std(self):
+
+        # Sample standard deviation, NaN where there are fewer than two values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / np.maximum(self.count - 1, 1)), np.nan)
+
+    def percentile(self, q):
+
+        # Percentile q (0-100) estimated from the histograms, linearly within the bin holding it and limited to the
+        # observed minimum and maximum. The first and last bins, which also count the values outside the edges, reach
+        # out to the observed minimum and maximum. NaN where there are no values.
+        cumulative = np.cumsum(self.histogram, axis=-1)
+        target = q / 100.0 * cumulative[..., -1:]
+        index = np.minimum((cumulative < target).sum(axis=-1, keepdims=True), self.histogram.shape[-1] - 1)
+        below = np.take_along_axis(cumulative, index, axis=-1) - np.take_along_axis(self.histogram, index, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.clip((target - below) / np.take_along_axis(self.histogram, index, axis=-1), 0.0, 1.0)
+        lower = np.where(index == 0, np.minimum(self.edges[0], self.minimum[..., np.newaxis]), self.edges[index])
+        upper = np.where(index == len(self.edges) - 2, np.maximum(self.edges[-1], self.maximum[..., np.newaxis]), self.edges[index + 1])
+        value = (lower + fraction * (upper - lower))[..., 0]
+        value = np.clip(value, self.minimum, self.maximum)
+        return np.where(self.count > 0, value, np.nan)
+
+    def merge(self, other):
+
+        # Add the statistics of another summary with the same months
+        self.count, self.mean, self.m2 = merge_moments(self.count, self.mean, self.m2, other.count, other.mean, other.m2)
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.histogram = self.histogram + other.histogram
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+
+    # Combine counts, means and sums of squared deviations of two sets of values (Chan et al.)
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, mean_a + delta * count_b / np.maximum(count, 1), 0.0)
+        m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / np.maximum(count, 1)
+    return count, mean, m2
+
+
+class SummaryStatistics:
+
+    '''
+    Streaming statistics of the colocation results of one dataset, per month, latitude band and (for profiles) level
+    of the pressure grid.
+    '''
+
+    def __init__(self, dataset, pressure_grid):
+        self.dataset = dataset
+        self.pressure_grid = np.asarray(pressure_grid, dtype=float)
+        self.months = np.empty(0, dtype='datetime64[M]')
+        self.variables = {name: VariableStatistics(edges, len(self.pressure_grid) if 'profile' in name else 1)
+                          for name, edges in HISTOGRAM_EDGES.items()}
+
+    def month_index(self, months):
+
+        # Index of each month, adding the months not seen yet (kept in time order)
+        new = np.setdiff1d(months, self.months)
+        if len(new):
+            self.months = np.concatenate([self.months, new])
+            for statistics in self.variables.values():
+                statistics.add_months(len(new))
+            order = np.argsort(self.months, kind='stable')
+            self.months = self.months[order]
+            for statistics in self.variables.values():
+                for name in ('count', 'mean', 'm2', 'minimum', 'maximum', 'histogram'):
+                    setattr(statistics, name, getattr(statistics, name)[order])
+        return np.searchsorted(self.months, months)
+
+    def update(self, chunk):
+
+        # Add a chunk of results, a dict of arrays holding time_vector, latitude_colocation and the summarised variables
+        month = self.month_index(np.asarray(chunk['time_vector']).astype('datetime64[M]'))
+        band = latitude_band(chunk['latitude_colocation'])
+        for m in np.unique(month):
+            rows = month == m
+            for name, statistics in self.variables.items():
+                statistics.update(m, band[rows], np.asarray(chunk[name])[rows])
+
+    def update_results(self, results, chunk_size=100000):
+
+        # Stream a ColocationResults through the accumulators, chunk_size rows at a time
+        names = ['time_vector', 'latitude_colocation'] + list(self.variables)
+        for start in range(0, len(results), chunk_size):
+            self.update({name: np.asarray(results[name][start:start + chunk_size]) for name in names})
+
+    def merge(self, other):
+
+        # Combine with the summary of another set of results of the same dataset
+        index = self.month_index(other.months)
+        for name, statistics in self.variables.items():
+            aligned = VariableStatistics(statistics.edges, statistics.levels, len(self.months))
+            source = other.variables[name]
+            for attribute in ('count', 'mean', 'm2', 'minimum', 'maximum', 'histogram'):
+                getattr(aligned, attribute)[index] = getattr(source, attribute)
+            statistics.merge(aligned)
+
+    def save(self, path):
+        arrays = {'dataset': np.asarray(self.dataset), 'pressure_grid': self.pressure_grid, 'months': self.months,
+                  'latitude_band_edges': LATITUDE_BAND_EDGES}
+        for name, statistics in self.variables.items():
+            arrays[f'{name}/edges'] = statistics.edges
+            for attribute in ('count', 'mean', 'm2', 'minimum', 'maximum', 'histogram'):
+                arrays[f'{name}/{attribute}'] = getattr(statistics, attribute)
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as npzfile:
+            summary = SummaryStatistics(str(npzfile['dataset']), npzfile['pressure_grid'])
+            summary.months = npzfile['months']
+            for name, statistics in summary.variables.items():
+                statistics.edges = npzfile[f'{name}/edges']
+                for attribute in ('count', 'mean', 'm2', 'minimum', 'maximum', 'histogram'):
+                    setattr(statistics, attribute, npzfile[f'{name}/{attribute}'])
+        return summary
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+import numpy as np
+import xarray as xr
+
+from .products import get_product
+
+'''
+Synthetic TROPESS L2 Lite files and WOUDC ozonesonde responses.
+
+Used to exercise and benchmark the colocation pipeline without the product archive or the WOUDC service. Daily files
+follow the TROPESS Lite variable layout and are written under a root directory at the product's file pattern, and
+sondes are returned by SyntheticWoudcClient, which mimics pywoudc's WoudcClient.get_data. A share of the soundings is
+placed close (in space and time) to the sondes, so every scale produces colocations.
+'''
+
+# Number of levels of the TROPESS Lite products
+LEVELS = 26
+
+
+def climatology(pressure):
+
+    # Rough ozone profile in ppb, from ~30 ppb at the surface to ~8 ppm in the stratosphere
+    log_pressure = np.log(np.clip(pressure, 0.1, 1100.0))
+    return np.interp(log_pressure, np.log([0.1, 10.0, 100.0, 300.0, 1100.0]), [3000.0, 8000.0, 1000.0, 80.0, 30.0])
+
+
+def sonde_launches(start_date, days, sondes_per_day, rng):
+
+    # Station, launch time and location of every synthetic sonde
+    launches = []
+    for day in range(days):
+        for s in range(sondes_per_day):
+            launch = start_date + timedelta(days=day, hours=int(rng.integers(0, 24)))
+            launches.append((f'{s:03}', launch, float(rng.uniform(-80.0, 80.0)), float(rng.uniform(-180.0, 180.0))))
+    return launches
+
+
+def data_block(rng, levels=2000, duration=False, missing=0):
+
+    # WOUDC style data_block CSV for one sonde, optionally with a leading Duration column and missing ozone values
+    pressure = np.geomspace(1010.0, 5.0, levels)
+    partial_pressure = climatology(pressure) * 1e-9 * pressure * 100 * 1000 * (1 + 0.05 * rng.standard_normal(levels))
+    rows = ['Duration,Pressure,O3PartialPressure,Temperature' if duration else 'Pressure,O3PartialPressure,Temperature']
+    gaps = set(rng.choice(levels, size=missing, replace=False).tolist()) if missing else set()
+    for k in range(levels):
+        ozone = '' if k in gaps else f'{partial_pressure[k]:.4f}'
+        rows.append((f'{k},' if duration else '') + f'{pressure[k]:.2f},{ozone},-50.0')
+    rows.append('')
+    return '\r\n'.join(rows)
+
+
+def sonde_features(launches, rng, levels=2000):
+
+    # GeoJSON features, as returned by the WOUDC ozonesonde service
+    features = []
+    for i, (station, launch, latitude, longitude) in enumerate(launches):
+        features.append({'type': 'Feature',
+                         'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                         'properties': {'gaw_id': station,
+                                        'instance_datetime': launch.strftime('%Y/%m/%d %H:%M:%S+00'),
+                                        'data_block': data_block(rng, levels, duration=(i % 3 == 0), missing=(i % 4))}})
+    return features
+
+
+def tropess_day(day, soundings_per_day, launches, rng, matches_per_sonde=5):
+
+    # One day of synthetic TROPESS Lite data, as an xarray Dataset
+    launches = [launch for launch in launches if launch[1].date() == day.date()]
+    near = min(len(launches) * matches_per_sonde, soundings_per_day)
+    n = soundings_per_day
+
+    latitude = rng.uniform(-90.0, 90.0, n)
+    longitude = rng.uniform(-180.0, 180.0, n)
+    hour = rng.uniform(0.0, 24.0, n)
+    if near:
+        # Soundings within ~50 km and an hour of a sonde
+        owner = np.arange(near) % len(launches)
+        sonde_latitude = np.asarray([launches[i][2] for i in owner])
+        sonde_longitude = np.asarray([launches[i][3] for i in owner])
+        latitude[:near] = sonde_latitude + rng.uniform(-0.3, 0.3, near)
+        longitude[:near] = sonde_longitude + rng.uniform(-0.3, 0.3, near) / np.maximum(np.cos(np.radians(sonde_latitude)), 0.1)
+        hour[:near] = np.clip(np.asarray([launches[i][1].hour for i in owner]) + rng.uniform(0.0, 1.0, near), 0.0, 23.99)
+
+    # Surface first pressure levels, the lowest few are unused over high terrain
+    pressure = np.tile(np.geomspace(1000.0, 0.1, LEVELS), (n, 1))
+    unused = rng.integers(0, 3, n)
+    pressure[np.arange(LEVELS)[np.newaxis, :] < unused[:, np.newaxis]] = -999.0
+
+    profile = climatology(np.abs(pressure)) * 1e-9
+    species = profile * (1 + 0.1 * rng.standard_normal((n, LEVELS)))
+    constraint = profile * (1 + 0.05 * rng.standard_normal((n, LEVELS)))
+    levels = np.arange(LEVELS)
+    kernel = 0.4 * np.exp(-((levels[:, np.newaxis] - levels[np.newaxis, :]) ** 2) / 4.0)
+    averaging_kernel = kernel[np.newaxis] * (1 + 0.1 * rng.uniform(-1.0, 1.0, (n, LEVELS, LEVELS)))
+
+    return xr.Dataset({'Quality': ('target', (rng.uniform(size=n) > 0.1).astype(np.int8)),
+                       'YYYYMMDD': ('target', np.full(n, float(day.strftime('%Y%m%d')))),
+                       'UT_Hour': ('target', hour.astype(np.float32)),
+                       'Latitude': ('target', latitude.astype(np.float32)),
+                       'Longitude': ('target', (((longitude + 180.0) % 360.0) - 180.0).astype(np.float32)),
+                       'Pressure': (('target', 'level'), pressure.astype(np.float32)),
+                       'Species': (('target', 'level'), species.astype(np.float32)),
+                       'ConstraintVector': (('target', 'level'), constraint.astype(np.float32)),
+                       'AveragingKernel': (('target', 'level', 'level2'), averaging_kernel.astype(np.float32))})
+
+
+def write_synthetic(root, dataset, start_date, days, soundings_per_day, sondes_per_day, seed=0, sonde_levels=2000):
+
+    # Write synthetic daily product files under root and return the matching WOUDC features
+    rng = np.random.default_rng(seed)
+    launches = sonde_launches(start_date, days, sondes_per_day, rng)
+    for j in range(days):
+        day = start_date + timedelta(days=j)
+        path = get_product(dataset).path(root, day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tropess_day(day, soundings_per_day, launches, rng).to_netcdf(path, engine='h5netcdf')
+    return sonde_features(launches, rng, sonde_levels)
+
+
+class SyntheticWoudcClient:
+
+    '''
+    Local stand in for pywoudc's WoudcClient, serving a fixed list of ozonesonde features. Counts the requests made.
+    '''
+
+    def __init__(self, features):
+        self.features = features
+        self.requests = 0
+
+    def get_data(self, typename, filters=None, temporal=None):
+        self.requests += 1
+        features = self.features
+        if filters and 'gaw_id' in filters:
+            stations = str(filters['gaw_id']).split(',')
+            features = [feature for feature in features if feature['properties']['gaw_id'] in stations]
+        if temporal:
+            begin, end = temporal
+            features = [feature for feature in features
+                        if begin <= datetime.strptime(feature['properties']['instance_datetime'], '%Y/%m/%d %H:%M:%S+00') < end]
+        return {'type': 'FeatureCollection', 'features': features}
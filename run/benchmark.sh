@@ -0,0 +1,36 @@
+#!/usr/bin/env bash
+
+# switch to ..
+script_path=`dirname ${BASH_SOURCE[0]}`
+pushd $script_path/..
+
+# everything is awesome
+umask 0
+
+# create output directory
+#mkdir -p ~/output_py/benchmark
+
+# run py-sonde-comparison benchmark, results are appended as one JSON line per run
+py-sonde-comparison benchmark \
+    --dataset TROPESS-CRIS \
+    --days 2 \
+    --soundings-per-day 100000 \
+    --sondes-per-day 40 \
+    --distance-location 100 \
+    --distance-time 3 \
+    --output ~/output_py/benchmark/benchmark.jsonl
+
+# start up time of the command line, and the heavy modules each command loads
+py-sonde-comparison startup-benchmark \
+    --repeats 5 \
+    --output ~/output_py/benchmark/startup.jsonl
+
+# peak memory of colocate over a short and a long date range, which should be the same with a fixed --window
+py-sonde-comparison memory-benchmark \
+    --short-days 15 \
+    --long-days 60 \
+    --window 5 \
+    --output ~/output_py/benchmark/memory.jsonl
+
+    
+popd
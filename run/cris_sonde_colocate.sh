@@ -17,7 +17,7 @@ time \
     --dataset TROPESS-CRIS \
     --start-date 2018-01-30 \
     --end-date 2018-06-30 \
-    --input ~/output_py \
+    --input /tb/CrIS/results/CRIS/Release_1.17.0/Global_Survey_Grid_0.8_RS \
     --output ~/output_py/ozonesonde/ \
     --ozone-units 'None' \
     --gaw-locations 'all' \
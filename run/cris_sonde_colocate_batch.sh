@@ -0,0 +1,50 @@
+#!/usr/bin/env bash
+
+# usage: cris_sonde_colocate_batch.sh init|work|status|merge
+# init once, then start work on as many nodes as wanted (e.g. one per cluster job), merge once status shows all units done
+
+# switch to ..
+script_path=`dirname ${BASH_SOURCE[0]}`
+pushd $script_path/..
+
+# everything is awesome
+umask 0
+
+# queue directory, on a filesystem shared by all nodes
+queue=~/output_py/ozonesonde/queue
+
+# run py-sonde-comparison
+case "$1" in
+  init)
+    py-sonde-comparison colocate-batch init \
+      --queue $queue \
+      --dataset TROPESS-CRIS \
+      --start-date 2012-01-01 \
+      --end-date 2024-01-01 \
+      --input /tb/CrIS/results/CRIS/Release_1.17.0/Global_Survey_Grid_0.8_RS \
+      --output ~/output_py/ozonesonde/ \
+      --ozone-units 'None' \
+      --gaw-locations 'all' \
+      --distance-location 100 \
+      --distance-time 3 \
+      --unit-days 30
+    ;;
+  work)
+    time \
+      py-sonde-comparison colocate-batch work \
+        --queue $queue
+    ;;
+  status)
+    py-sonde-comparison colocate-batch status \
+      --queue $queue
+    ;;
+  merge)
+    py-sonde-comparison colocate-batch merge \
+      --queue $queue
+    ;;
+  *)
+    echo "usage: $0 init|work|status|merge"
+    ;;
+esac
+
+popd
@@ -13,6 +13,7 @@ setup(name='py_sonde_comparison',
         'numpy==1.22.0',
         'netCDF4==1.5.8',
         'xarray==2022.3.0',
+        'pandas==1.4.1',
         'matplotlib==3.5.1',
         'h5netcdf==1.0.0',
         'seaborn==0.12.0',